@@ -0,0 +1 @@
+default_app_config = 'Chat_opinion.apps.ChatOpinionConfig'
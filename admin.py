@@ -4,8 +4,47 @@ from .models import (
     ChatOpinionQuestion, ChatOptionAnswer,
     ChatOpinionConversation
 )
+from .paginators import EstimatedCountPaginator
 
-# Register your models here.
-admin.site.register(ChatOpinionQuestion)
-admin.site.register(ChatOptionAnswer)
-admin.site.register(ChatOpinionConversation)
+
+class NumericSearchMixin(object):
+    """
+        For admins searching on ``=...__id`` only: other terms are dropped,
+        before Django 4.0 they end in a ValueError (a 500) in the lookup.
+    """
+
+    def get_search_results(self, request, queryset, search_term):
+        terms = [term for term in search_term.split() if term.isdigit()]
+        if search_term.strip() and not terms:
+            return queryset.none(), False
+        return super(NumericSearchMixin, self).get_search_results(
+            request, queryset, ' '.join(terms))
+
+
+@admin.register(ChatOpinionQuestion)
+class ChatOpinionQuestionAdmin(admin.ModelAdmin):
+    list_display = ('label', 'code', 'field_type', 'required')
+    search_fields = ('label', 'code')
+
+
+@admin.register(ChatOptionAnswer)
+class ChatOptionAnswerAdmin(NumericSearchMixin, admin.ModelAdmin):
+    list_display = ('id', 'question_label', 'booking_id', 'basket_id')
+    raw_id_fields = ('question', 'booking', 'basket')
+    search_fields = ('=booking__id', '=basket__id')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+@admin.register(ChatOpinionConversation)
+class ChatOpinionConversationAdmin(NumericSearchMixin, admin.ModelAdmin):
+    list_display = ('__str__', 'booking_id', 'is_doctor_message', 'is_read',
+                    'created')
+    list_filter = ('is_doctor_message',)
+    list_select_related = ('patient', 'doctor__user')
+    raw_id_fields = ('booking', 'patient', 'doctor', 'notification',
+                     'doctor_attachments', 'patient_attachments')
+    search_fields = ('=booking__id',)
+    date_hierarchy = 'created'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
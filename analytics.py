@@ -0,0 +1,129 @@
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from booking.models import booking
+from config.models import Speciality
+from core.choices import COMPLETE, IN_PROGRESS
+from .models import CaseResponseTimes, ResponseTimeStat
+
+
+# upper bounds in seconds of the histogram buckets, plus an overflow one
+BUCKETS = (60, 5 * 60, 15 * 60, 30 * 60, 60 * 60, 2 * 3600, 4 * 3600,
+           8 * 3600, 12 * 3600, 24 * 3600, 48 * 3600, 72 * 3600,
+           7 * 24 * 3600)
+
+# milestone field -> metric, by the status moving a case there
+STATUS_MILESTONES = {
+    IN_PROGRESS: ('accepted_at', ResponseTimeStat.TIME_TO_ACCEPT),
+    COMPLETE: ('completed_at', ResponseTimeStat.TIME_TO_COMPLETE),
+}
+
+
+def histogram_percentile(histogram, percent):
+    """ Percentile interpolated inside its bucket, None when empty. """
+    total = sum(histogram)
+    if not total:
+        return None
+    rank = percent / 100.0 * total
+    seen = 0
+    for index, count in enumerate(histogram):
+        if count and seen + count >= rank:
+            lower = BUCKETS[index - 1] if index else 0
+            upper = BUCKETS[index] if index < len(BUCKETS) else lower
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return float(BUCKETS[-1])
+
+
+def record(doctor_id, metric, seconds, when):
+    if doctor_id is None:
+        return
+    seconds = max(seconds, 0)
+    with transaction.atomic():
+        stat, _ = ResponseTimeStat.objects.select_for_update().get_or_create(
+            doctor_id=doctor_id, day=timezone.localdate(when), metric=metric,
+            defaults={'histogram': [0] * (len(BUCKETS) + 1)})
+        stat.histogram[bisect_left(BUCKETS, seconds)] += 1
+        stat.count += 1
+        stat.total_seconds += seconds
+        stat.p50 = histogram_percentile(stat.histogram, 50)
+        stat.p90 = histogram_percentile(stat.histogram, 90)
+        stat.save()
+
+
+def _reach_milestone(booking_id, doctor_id, field, when):
+    """ True the first time the case reaches the milestone. """
+    CaseResponseTimes.objects.get_or_create(booking_id=booking_id,
+                                            defaults={'doctor_id': doctor_id})
+    return bool(CaseResponseTimes.objects.filter(
+        booking_id=booking_id, **{f'{field}__isnull': True}
+    ).update(**{field: when, 'doctor_id': doctor_id}))
+
+
+def status_changed(pks, status):
+    if status not in STATUS_MILESTONES:
+        return
+    field, metric = STATUS_MILESTONES[status]
+    now = timezone.now()
+    rows = booking.objects.filter(pk__in=pks).values_list(
+        'pk', 'doctor_id', 'created')
+    for pk, doctor_id, created in rows:
+        if _reach_milestone(pk, doctor_id, field, now):
+            record(doctor_id, metric, (now - created).total_seconds(), now)
+
+
+def doctor_replied(conversation):
+    row = booking.objects.filter(pk=conversation.booking_id).values_list(
+        'doctor_id', 'created').first()
+    if row is None:
+        return
+    doctor_id, created = row
+    if _reach_milestone(conversation.booking_id, doctor_id,
+                        'first_doctor_reply_at', conversation.created):
+        record(doctor_id, ResponseTimeStat.TIME_TO_FIRST_REPLY,
+               (conversation.created - created).total_seconds(),
+               conversation.created)
+
+
+def response_time_report(since=None, until=None, doctor=None, speciality=None,
+                         metric=None, by_doctor=False):
+    """
+        Daily statistics merged over doctors (or per doctor), read from
+        the aggregate table only.
+    """
+    until = until or timezone.localdate()
+    since = since or until - timedelta(days=30)
+    stats = ResponseTimeStat.objects.filter(day__gte=since, day__lte=until)
+    if doctor:
+        stats = stats.filter(doctor_id=doctor)
+    if speciality:
+        stats = stats.filter(doctor__in=Speciality.objects.filter(
+            slug=speciality).values('doctor_specialities'))
+    if metric:
+        stats = stats.filter(metric=metric)
+
+    merged = {}
+    rows = stats.order_by('day', 'metric').values_list(
+        'doctor_id', 'day', 'metric', 'count', 'total_seconds', 'histogram')
+    for doctor_id, day, name, count, total, histogram in rows:
+        key = (doctor_id if by_doctor else None, day, name)
+        entry = merged.setdefault(key, [0, 0.0, [0] * (len(BUCKETS) + 1)])
+        entry[0] += count
+        entry[1] += total
+        entry[2] = [a + b for a, b in zip(entry[2], histogram)]
+
+    report = []
+    for (doctor_id, day, name), (count, total, histogram) in merged.items():
+        row = {
+            'day': day, 'metric': name, 'count': count,
+            'mean': total / count if count else None,
+            'p50': histogram_percentile(histogram, 50),
+            'p90': histogram_percentile(histogram, 90),
+        }
+        if by_doctor:
+            row['doctor'] = doctor_id
+        report.append(row)
+    return report
@@ -1,5 +1,6 @@
 from collections import OrderedDict
 from core.choices import PATIENT
+from django.urls import reverse
 from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from wagtail.core.models import Collection
@@ -8,7 +9,11 @@ from patient.api.serializers import PatientSerializer
 from utils.file_upload import filename_to_title
 from django.utils import timezone
 from datetime import datetime
+from ..archive import archived_messages
+from ..instrumentation import TimedSerializerMixin
 from ..models import Complaint, ChatOptionAnswer, ChatOpinionConversation
+from ..questionnaires import answer_label
+from ..thumbnails import with_thumbnail
 from booking.models import booking
 from django.utils import timezone
 from datetime import datetime
@@ -22,6 +27,32 @@ STATUSES = {
 }
 
 
+def attachments_data(documents, booking_id, context=None):
+    """
+        AttachmentSerializer data pointing to the protected download URLs
+        of the booking instead of the public media files, with the
+        ``thumbnail`` URL of every document (None until it is generated).
+    """
+    from booking.api.serializers import AttachmentSerializer
+    documents = list(documents)
+    kwargs = {'context': context} if context is not None else {}
+    data = AttachmentSerializer(documents, many=True, **kwargs).data
+    request = context.get('request', None) if context else None
+    thumbnails = with_thumbnail(documents)
+    for document, item in zip(documents, data):
+        url_kwargs = {'pk': booking_id, 'document_pk': document.pk}
+        url = reverse('chatting_api:chat-opinion-attachment',
+                      kwargs=url_kwargs)
+        thumbnail = reverse('chatting_api:chat-opinion-attachment-thumbnail',
+                            kwargs=url_kwargs)
+        if request is not None:
+            url = request.build_absolute_uri(url)
+            thumbnail = request.build_absolute_uri(thumbnail)
+        item['attachment'] = url
+        item['thumbnail'] = thumbnail if document.pk in thumbnails else None
+    return data
+
+
 class ComplaintSerializer(serializers.ModelSerializer):
     class Meta:
         model = Complaint
@@ -43,6 +74,15 @@ class ComplaintSerializer(serializers.ModelSerializer):
         return attrs
 
 
+class BulkCaseActionSerializer(serializers.Serializer):
+    """ Body of the bulk accept/complete request. """
+    MAX_IDS = 200
+
+    action = serializers.ChoiceField(choices=('accept', 'complete'))
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1),
+                                min_length=1, max_length=MAX_IDS)
+
+
 class ChatOptionAnswerSerializers(serializers.ModelSerializer):
     question_label = serializers.SerializerMethodField(read_only=True)
 
@@ -51,10 +91,11 @@ class ChatOptionAnswerSerializers(serializers.ModelSerializer):
         fields = ('question_label', 'answer')
 
     def get_question_label(self, obj):
-        return obj.question.label if obj.question else obj.question_label
+        return answer_label(obj)
 
 
-class ConversationSerializer(serializers.ModelSerializer):
+class ConversationSerializer(TimedSerializerMixin,
+                             serializers.ModelSerializer):
     booking_data = serializers.SerializerMethodField(read_only=True)
     patient_can_replay = serializers.ReadOnlyField()
     doctor_attachments = serializers.SerializerMethodField(read_only=True)
@@ -64,6 +105,7 @@ class ConversationSerializer(serializers.ModelSerializer):
     class Meta:
         model = ChatOpinionConversation
         exclude = ('modified',)
+        read_only_fields = ('is_read',)
 
         extra_kwargs = {
             'patient': {
@@ -86,23 +128,13 @@ class ConversationSerializer(serializers.ModelSerializer):
 
     def get_patient_attachments(self, obj):
         request = self.context['request']
-        from booking.api.serializers import AttachmentSerializer
-        qs = obj.patient_attachments.all()
-        if qs.exists():
-            return AttachmentSerializer(qs, many=True,
-                                        context={'request': request}
-                                        ).data
-        return []
+        return attachments_data(obj.patient_attachments.all(), obj.booking_id,
+                                context={'request': request})
 
     def get_doctor_attachments(self, obj):
         request = self.context['request']
-        from booking.api.serializers import AttachmentSerializer
-        qs = obj.doctor_attachments.all()
-        if qs.exists():
-            return AttachmentSerializer(qs, many=True,
-                                        context={'request': request}
-                                        ).data
-        return []
+        return attachments_data(obj.doctor_attachments.all(), obj.booking_id,
+                                context={'request': request})
 
     def create(self, validated_data):
         booking = validated_data.get('booking')
@@ -166,7 +198,38 @@ class ConversationSerializer(serializers.ModelSerializer):
                         instance.patient_attachments.add(file)
 
 
-class ChatOpinionSerializer(serializers.ModelSerializer):
+def archived_conversation_data(archive, request):
+    """
+        Render an archived thread in the same shape as
+        ConversationSerializer, with one query for all its attachments.
+    """
+    from booking.api.serializers import bookingSerializer
+    messages = archived_messages(archive)
+    document_ids = set()
+    for message in messages:
+        document_ids.update(message['doctor_attachments'])
+        document_ids.update(message['patient_attachments'])
+    documents = get_document_model().objects.in_bulk(document_ids)
+    booking_data = bookingSerializer(instance=archive.booking,
+                                     context={'request': request}).data
+    created_field = serializers.DateTimeField()
+
+    for message in messages:
+        del message['modified']
+        message['created'] = created_field.to_representation(message['created'])
+        message['booking_data'] = booking_data
+        message['patient_can_replay'] = False
+        message.setdefault('is_read', True)
+        for key in ('doctor_attachments', 'patient_attachments'):
+            attachments = [documents[pk] for pk in message[key]
+                           if pk in documents]
+            message[key] = attachments_data(attachments, archive.booking_id,
+                                            context={'request': request})
+    return messages
+
+
+class ChatOpinionSerializer(TimedSerializerMixin,
+                            serializers.ModelSerializer):
     status = serializers.SerializerMethodField(read_only=True)
     status_display = serializers.SerializerMethodField(read_only=True)
     patient = serializers.SerializerMethodField(read_only=True)
@@ -194,8 +257,8 @@ class ChatOpinionSerializer(serializers.ModelSerializer):
                   'creation_date', 'attachments', 'questions_ans', 'can_share_data')
 
     def get_attachments(self, obj):
-        from booking.api.serializers import AttachmentSerializer
-        return AttachmentSerializer(obj.attachments, many=True).data
+        return attachments_data(obj.attachments.all(), obj.pk,
+                                context=self.context)
 
     def get_doctor(self, obj):
         from doctor.api.serializers import DoctorSerializer
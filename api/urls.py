@@ -3,7 +3,9 @@ from django.conf.urls import *
 
 from .views import (
     ComplaintViewSet, ChatOpinionConversationViewSet, ChatOpinionViewSet,AcceptChatOpinionCase,
-    CompletedChatOpinionCase
+    CompletedChatOpinionCase, BulkChatOpinionCaseAction, ChatOpinionMetricsView,
+    ChatOpinionCaseExport, ChatOpinionAttachmentDownload, UnreadMessagesView,
+    DoctorInboxView, ChatOpinionDataExport, ChatOpinionResponseTimes
 )
 
 app_name = 'chatting_api'
@@ -13,11 +15,32 @@ router.register('chat-opinion', ChatOpinionViewSet, basename='chat-opinion')
 router.register('complaint', ComplaintViewSet, basename='complaint')
 router.register('chat', ChatOpinionConversationViewSet, basename='chat')
 
-urlpatterns = router.urls
+urlpatterns = [
+    # before the router so "bulk" is not taken for a booking pk
+    url(r'^chat-opinion/bulk/$', BulkChatOpinionCaseAction.as_view(),
+        name='chat-opinion-bulk'),
+    url(r'^chat/unread/$', UnreadMessagesView.as_view(), name='chat-unread'),
+    url(r'^chat/inbox/$', DoctorInboxView.as_view(), name='chat-inbox'),
+]
+
+urlpatterns += router.urls
 
 urlpatterns +=[
     url(r'^chat-opinion/(?P<pk>[0-9]+)/accept/$',AcceptChatOpinionCase.as_view(),
     name='Chat-opinion-accept'),
     url(r'^chat-opinion/(?P<pk>[0-9]+)/completed/$',CompletedChatOpinionCase.as_view(),
     name='chat-opinion-complete'),
+    url(r'^chat-opinion/(?P<pk>[0-9]+)/export/$', ChatOpinionCaseExport.as_view(),
+    name='chat-opinion-export'),
+    url(r'^chat-opinion/(?P<pk>[0-9]+)/attachments/(?P<document_pk>[0-9]+)/$',
+    ChatOpinionAttachmentDownload.as_view(), name='chat-opinion-attachment'),
+    url(r'^chat-opinion/(?P<pk>[0-9]+)/attachments/(?P<document_pk>[0-9]+)/thumbnail/$',
+    ChatOpinionAttachmentDownload.as_view(thumbnail=True),
+    name='chat-opinion-attachment-thumbnail'),
+    url(r'^chat-opinion-export/(?P<dataset>[a-z]+)/$', ChatOpinionDataExport.as_view(),
+    name='chat-opinion-data-export'),
+    url(r'^chat-opinion-analytics/$', ChatOpinionResponseTimes.as_view(),
+    name='chat-opinion-analytics'),
+    url(r'^chat-opinion-metrics/$', ChatOpinionMetricsView.as_view(),
+    name='chat-opinion-metrics'),
 ]
@@ -1,18 +1,36 @@
 from django.utils.translation import gettext_lazy as _
 from rest_framework.mixins import CreateModelMixin, ListModelMixin
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.serializers import ValidationError
 from rest_framework.viewsets import GenericViewSet
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import mixins
+from rest_framework.fields import DateTimeField
 from django.db.models import Q
 from django.db.models import Count, Max
-from django.http import Http404
+from django.utils.dateparse import parse_date
+from django.http import Http404, HttpResponse, StreamingHttpResponse
 from notification.models import Notification
 from .serializers import ComplaintSerializer, ConversationSerializer
-from .serializers import ChatOpinionSerializer
-from ..models import Complaint, ChatOpinionConversation
+from .serializers import ChatOpinionSerializer, archived_conversation_data
+from .serializers import BulkCaseActionSerializer
+from ..analytics import response_time_report
+from ..bulk_export import DATASETS, FORMATS, export_rows, parse_watermark
+from ..downloads import get_booking_document, serve_file
+from ..export import iter_case_zip
+from ..inbox import doctor_inbox
+from ..instrumentation import prometheus_text
+from ..models import (
+    AttachmentThumbnail, Complaint, ChatOpinionArchive,
+    ChatOpinionConversation, ResponseTimeStat
+)
+from ..routers import ReplicaReadsMixin
+from ..throttling import (
+    ChatMessageBookingThrottle, ChatMessageUserThrottle, ChatUploadThrottle
+)
+from ..transitions import transition_instance, transition_many
+from ..unread import mark_read, unread_count
 from booking.models import booking
 
 from core.choices import (
@@ -54,8 +72,8 @@ class ComplaintViewSet(CreateModelMixin, GenericViewSet):
     queryset = Complaint.objects.all()
 
 
-class ChatOpinionConversationViewSet(ListModelMixin, CreateModelMixin,
-                                       GenericViewSet):
+class ChatOpinionConversationViewSet(ReplicaReadsMixin, ListModelMixin,
+                                     CreateModelMixin, GenericViewSet):
     """
         API endpoint for Chat-Opinion Chat
 
@@ -75,13 +93,15 @@ class ChatOpinionConversationViewSet(ListModelMixin, CreateModelMixin,
                     "doctor_attachments": [
                                             {
                                                 "name": "ReportFile1.Png",
-                                                "attachment": "http://127.0.0.1:8000/media/documents/file1.png.png"
+                                                "attachment": "http://127.0.0.1:8000/api/v1/chat-opinion/15/attachments/42/",
+                                                "thumbnail": "http://127.0.0.1:8000/api/v1/chat-opinion/15/attachments/42/thumbnail/"
                                             }
                                         ],
                     "patient_attachments": [
                                             {
                                                 "name": "Report.Png",
-                                                "attachment": "http://127.0.0.1:8000/media/documents/file1.png.png"
+                                                "attachment": "http://127.0.0.1:8000/api/v1/chat-opinion/15/attachments/43/",
+                                                "thumbnail": null
                                             }
                                         ],
                 }
@@ -123,11 +143,23 @@ class ChatOpinionConversationViewSet(ListModelMixin, CreateModelMixin,
                         "Maximum Replies limit is 3"
                     ]
                 }
+
+            ** too many messages (per user and per booking) or upload
+               bytes: 429 with a Retry-After header.
         """
     serializer_class = ConversationSerializer
     permission_classes = [IsAuthenticated]
     pagination_class = None
     queryset = ChatOpinionConversation.objects.all()
+    # read on a replica, see routers.ReplicaReadsMixin
+    replica_actions = ('list',)
+
+    def get_throttles(self):
+        if self.action == 'create':
+            # the booking throttle parses the body, keep it last
+            return [ChatMessageUserThrottle(), ChatUploadThrottle(),
+                    ChatMessageBookingThrottle()]
+        return super(ChatOpinionConversationViewSet, self).get_throttles()
 
     def get_queryset(self):
         booking = self.request.GET.get('booking', None)
@@ -150,11 +182,31 @@ class ChatOpinionConversationViewSet(ListModelMixin, CreateModelMixin,
         for elem in doctor_notifications:
             elem.is_read = True
             elem.save()
+        mark_read(qs, user)
         return qs
 
+    def list(self, request, *args, **kwargs):
+        response = super(ChatOpinionConversationViewSet, self).list(
+            request, *args, **kwargs)
+        if not response.data:
+            # closed threads may have been moved to the archive
+            archive = self.get_archive()
+            if archive:
+                response.data = archived_conversation_data(archive, request)
+        return response
+
+    def get_archive(self):
+        qs = ChatOpinionArchive.objects.select_related('booking').filter(
+            booking__id=self.request.GET.get('booking'))
+        if self.request.user.is_doctor:
+            qs = qs.filter(booking__doctor__user=self.request.user)
+        else:
+            qs = qs.filter(booking__patient__parent=self.request.user)
+        return qs.first()
 
-class ChatOpinionViewSet(mixins.ListModelMixin,
-                           GenericViewSet):
+
+class ChatOpinionViewSet(ReplicaReadsMixin, mixins.ListModelMixin,
+                         GenericViewSet):
 
     """
     Endpoint to Retrieve, Update booking
@@ -175,6 +227,8 @@ class ChatOpinionViewSet(mixins.ListModelMixin,
     serializer_class = ChatOpinionSerializer
     queryset = booking.objects.filter(service_type__slug="Chat-opinion")
     permission_classes = [IsAuthenticated]
+    # read on a replica, see routers.ReplicaReadsMixin
+    replica_actions = ('list',)
 
     def list(self, request, *args, **kwargs):
         # override to pass user into serializer
@@ -254,9 +308,13 @@ class AcceptChatOpinionCase(APIView):
         booking = self.get_object(pk=pk)
         if self.request.user.is_authenticated and self.request.user.is_doctor:
             doctor = self.request.user.doctor
-            if booking.doctor == doctor:
-                booking.status = IN_PROGRESS
-                booking.save()
+            if booking.doctor_id == doctor.pk:
+                if not transition_instance(booking, IN_PROGRESS, user=request.user):
+                    # repeated calls are fine, other statuses are not
+                    booking.refresh_from_db(fields=['status'])
+                    if booking.status != IN_PROGRESS:
+                        return Response({'message': _('This booking can not be accepted in its current status')},
+                                        status=HTTP_400_BAD_REQUEST)
                 serializer = ChatOpinionSerializer(
                     booking, user=request.user)
                 return Response(serializer.data)
@@ -280,9 +338,13 @@ class CompletedChatOpinionCase(APIView):
         booking = self.get_object(pk=pk)
         if self.request.user.is_authenticated and self.request.user.is_doctor:
             doctor = self.request.user.doctor
-            if booking.doctor == doctor:
-                booking.status = COMPLETE
-                booking.save()
+            if booking.doctor_id == doctor.pk:
+                if not transition_instance(booking, COMPLETE, user=request.user):
+                    # repeated calls are fine, other statuses are not
+                    booking.refresh_from_db(fields=['status'])
+                    if booking.status != COMPLETE:
+                        return Response({'message': _('This booking can not be completed in its current status')},
+                                        status=HTTP_400_BAD_REQUEST)
                 serializer = ChatOpinionSerializer(
                     booking, user=request.user)
                 return Response(serializer.data)
@@ -290,3 +352,299 @@ class CompletedChatOpinionCase(APIView):
                 return Response({'message': 'You are not authorized for complete this booking'}, status=HTTP_400_BAD_REQUEST)
         else:
             return Response({'message': 'Something is wrong with token'}, status=HTTP_400_BAD_REQUEST)
+
+
+class BulkChatOpinionCaseAction(APIView):
+    """
+        Accept or complete many Chat-Opinion cases of the logged in doctor
+
+        * /api/v1/chat-opinion/bulk/
+
+        ** POST Request **
+
+            {
+                "action": "accept",  <---- "accept" or "complete"
+                "ids": [13, 14, 15]
+            }
+
+        **returns:**
+
+            {
+                "action": "accept",
+                "status": "in-progress",
+                "results": {
+                    "13": "updated",
+                    "14": "unchanged",  <---- already in the target status
+                    "15": "not_found"   <---- or "forbidden", "invalid_status"
+                }
+            }
+    """
+    permission_classes = [IsAuthenticated]
+    actions = {
+        'accept': IN_PROGRESS,
+        'complete': COMPLETE,
+    }
+
+    def post(self, request, format=None):
+        if not request.user.is_doctor:
+            return Response({'message': 'Something is wrong with token'}, status=HTTP_400_BAD_REQUEST)
+
+        # a list of ids only: a string would be iterated digit by digit
+        serializer = BulkCaseActionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=HTTP_400_BAD_REQUEST)
+        action = serializer.validated_data['action']
+        ids = list(dict.fromkeys(serializer.validated_data['ids']))
+
+        target = self.actions[action]
+        results = {pk: 'not_found' for pk in ids}
+        owned = {}
+        # ownership and current status of every requested case in one query
+        rows = booking.objects.filter(
+            pk__in=ids, service_type__slug='Chat-opinion'
+        ).values_list('pk', 'doctor__user_id', 'status')
+        for pk, doctor_user_id, status in rows:
+            if doctor_user_id != request.user.pk:
+                results[pk] = 'forbidden'
+            else:
+                owned[pk] = status
+
+        moved = set(transition_many(
+            [pk for pk, status in owned.items() if status != target],
+            target, user=request.user))
+        for pk, status in owned.items():
+            if pk in moved:
+                results[pk] = 'updated'
+            elif status == target:
+                results[pk] = 'unchanged'
+            else:
+                results[pk] = 'invalid_status'
+
+        return Response({
+            'action': action,
+            'status': target,
+            'results': {str(pk): result for pk, result in results.items()}
+        })
+
+
+class ChatOpinionCaseExport(APIView):
+    """
+        Download a whole Chat-Opinion case as a ZIP file: transcript,
+        questionnaire answers and all attachments, streamed as it is built.
+
+        * /api/v1/chat-opinion/15/export/
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get_object(self, pk):
+        user = self.request.user
+        try:
+            return booking.objects.filter(
+                Q(user=user) | Q(patient__parent=user) | Q(doctor__user=user)
+            ).get(pk=pk, service_type__slug='Chat-opinion')
+        except booking.DoesNotExist:
+            raise Http404
+
+    def get(self, request, pk, format=None):
+        instance = self.get_object(pk=pk)
+        response = StreamingHttpResponse(iter_case_zip(instance),
+                                         content_type='application/zip')
+        response['Content-Disposition'] = \
+            f'attachment; filename="chat-opinion-{instance.pk}.zip"'
+        return response
+
+
+class ChatOpinionAttachmentDownload(APIView):
+    """
+        Download a case or chat attachment of a Chat-Opinion booking, for
+        the participants of that booking only. Range requests are supported.
+        The serializers only link attachments and previews through here.
+
+        * /api/v1/chat-opinion/15/attachments/42/
+        * /api/v1/chat-opinion/15/attachments/42/thumbnail/
+    """
+    permission_classes = [IsAuthenticated]
+    thumbnail = False
+
+    def get(self, request, pk, document_pk, format=None):
+        document = get_booking_document(request.user, pk, document_pk)
+        if document is None:
+            raise Http404
+        if not self.thumbnail:
+            return serve_file(request, document.file)
+        thumbnail = AttachmentThumbnail.objects.filter(document=document).first()
+        if thumbnail is None:
+            raise Http404
+        return serve_file(request, thumbnail.file, as_attachment=False)
+
+
+class DoctorInboxView(APIView):
+    """
+        Active Chat-Opinion threads of the logged in doctor with their last
+        message, most recent activity first
+
+        * /api/v1/chat/inbox/?limit=20&cursor=<next>
+
+        **returns:**
+
+            {
+                "results": [
+                    {
+                        "booking": 15,
+                        "status": "in-progress",
+                        "patient": "John Doe",
+                        "last_message": "hello",
+                        "last_message_from": "patient",  <---- or "doctor", null
+                        "last_message_at": "2020-01-17T10:11:23.185706+03:00",
+                        "reply_pending": true
+                    }
+                ],
+                "next": "MjAyMC0wMS0xN1QxMDox..."  <---- null on the last page
+            }
+    """
+    permission_classes = [IsAuthenticated]
+    max_limit = 100
+
+    def get(self, request, format=None):
+        if not request.user.is_doctor:
+            return Response({'message': 'Something is wrong with token'}, status=HTTP_400_BAD_REQUEST)
+        limit = request.GET.get('limit', '')
+        limit = min(int(limit), self.max_limit) if limit.isdigit() and int(limit) else 20
+        threads, next_cursor = doctor_inbox(
+            request.user, cursor=request.GET.get('cursor', None), limit=limit)
+
+        field = DateTimeField()
+        results = []
+        for thread in threads:
+            if thread.last_message_at is None:
+                sender = None
+            else:
+                sender = 'doctor' if thread.last_is_doctor_message else 'patient'
+            results.append({
+                'booking': thread.booking_id,
+                'status': thread.booking.status,
+                'patient': thread.booking.patient.get_full_name() if thread.booking.patient else None,
+                'last_message': thread.last_message,
+                'last_message_from': sender,
+                'last_message_at': field.to_representation(thread.last_message_at)
+                if thread.last_message_at else None,
+                'reply_pending': sender != 'doctor',
+            })
+        return Response({'results': results, 'next': next_cursor})
+
+
+class UnreadMessagesView(APIView):
+    """
+        Unread chat messages of the logged in user, for the app badge
+
+        * /api/v1/chat/unread/
+
+        **returns:**
+
+            {
+                "unread": 3
+            }
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        return Response({'unread': unread_count(request.user)})
+
+
+class ChatOpinionDataExport(APIView):
+    """
+        Stream complaints or questionnaire answers for analytics (staff only)
+
+        * /api/v1/chat-opinion-export/complaints/?output=csv&since=2021-02-23T00:00:00Z
+        * /api/v1/chat-opinion-export/answers/?output=jsonl&since=1500
+
+        ``since`` is the last watermark already exported: the ``modified``
+        column for complaints, the ``id`` column for answers. Rows just
+        before it are sent again to catch late commits, deduplicate them
+        on (``id``, watermark).
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, dataset, format=None):
+        if dataset not in DATASETS:
+            raise Http404
+        # not "format": rest_framework keeps it for content negotiation
+        output = request.GET.get('output', 'csv')
+        if output not in FORMATS:
+            return Response({'output': [_('Invalid format')]}, status=HTTP_400_BAD_REQUEST)
+        since = request.GET.get('since', None) or None
+        if since is not None:
+            try:
+                since = parse_watermark(dataset, since)
+            except ValueError:
+                return Response({'since': [_('Invalid watermark')]}, status=HTTP_400_BAD_REQUEST)
+
+        lines, content_type = FORMATS[output]
+        response = StreamingHttpResponse(
+            lines(dataset, export_rows(dataset, since)), content_type=content_type)
+        response['Content-Disposition'] = \
+            f'attachment; filename="chat-opinion-{dataset}.{output}"'
+        return response
+
+
+class ChatOpinionResponseTimes(APIView):
+    """
+        Daily Chat-Opinion response times (staff only), read from the
+        pre-aggregated statistics. Times are in seconds.
+
+        * /api/v1/chat-opinion-analytics/?since=2021-02-01&until=2021-02-28
+          &metric=time_to_accept&doctor=6&speciality=cardiology&by=doctor
+
+        **returns:**
+
+            [
+                {
+                    "day": "2021-02-23",
+                    "metric": "time_to_accept",
+                    "count": 12,
+                    "mean": 5400.0,
+                    "p50": 3240.0,
+                    "p90": 12600.0,
+                    "doctor": 6   <---- only with by=doctor
+                }
+            ]
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        params = request.GET
+        dates = {}
+        for name in ('since', 'until'):
+            value = params.get(name, '') or ''
+            try:
+                # None when malformed, ValueError for a day like 2021-02-30
+                dates[name] = parse_date(value) if value else None
+            except ValueError:
+                dates[name] = None
+            if value and dates[name] is None:
+                return Response({name: [_('Invalid date')]}, status=HTTP_400_BAD_REQUEST)
+        metric = params.get('metric', None)
+        if metric and metric not in dict(ResponseTimeStat.METRICS):
+            return Response({'metric': [_('Invalid metric')]}, status=HTTP_400_BAD_REQUEST)
+        doctor = params.get('doctor', '')
+        report = response_time_report(
+            since=dates['since'], until=dates['until'], metric=metric,
+            doctor=int(doctor) if doctor.isdigit() else None,
+            speciality=params.get('speciality', None),
+            by_doctor=params.get('by', None) == 'doctor')
+        return Response(report)
+
+
+class ChatOpinionMetricsView(APIView):
+    """
+        Request metrics of the Chat-opinion views collected by
+        ChatOpinionMetricsMiddleware in this process, in the Prometheus
+        text format.
+
+        * /api/v1/chat-opinion-metrics/
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return HttpResponse(prometheus_text(),
+                            content_type='text/plain; version=0.0.4')
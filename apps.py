@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ChatOpinionConfig(AppConfig):
     name = 'Chat_opinion'
+
+    def ready(self):
+        from . import signals  # noqa: F401
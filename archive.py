@@ -0,0 +1,116 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from booking.models import booking
+from .models import ChatOpinionArchive, ChatOpinionConversation
+
+
+CLOSED_STATUSES = ('completed', 'cancelled')
+ARCHIVE_AFTER_DAYS = getattr(settings, 'CHAT_OPINION_ARCHIVE_AFTER_DAYS', 90)
+
+
+def _attachment_ids(field_name, conversation_ids):
+    field = ChatOpinionConversation._meta.get_field(field_name)
+    through = field.remote_field.through
+    source = field.m2m_field_name() + '_id'
+    target = field.m2m_reverse_field_name() + '_id'
+    attachments = {}
+    rows = through.objects.filter(**{source + '__in': conversation_ids})
+    for conversation_id, document_id in rows.values_list(source, target):
+        attachments.setdefault(conversation_id, []).append(document_id)
+    return attachments
+
+
+def serialize_conversations(conversations):
+    conversation_ids = [conversation.pk for conversation in conversations]
+    doctor_attachments = _attachment_ids('doctor_attachments', conversation_ids)
+    patient_attachments = _attachment_ids('patient_attachments',
+                                          conversation_ids)
+    return [{
+        'id': conversation.pk,
+        'created': conversation.created.isoformat(),
+        'modified': conversation.modified.isoformat(),
+        'patient': conversation.patient_id,
+        'doctor': conversation.doctor_id,
+        'booking': conversation.booking_id,
+        'is_doctor_message': conversation.is_doctor_message,
+        'message': conversation.message,
+        'notification': conversation.notification_id,
+        'doctor_attachments': doctor_attachments.get(conversation.pk, []),
+        'patient_attachments': patient_attachments.get(conversation.pk, []),
+    } for conversation in conversations]
+
+
+@transaction.atomic
+def archive_booking(booking_id):
+    """
+        Move the conversation of a booking into its archive row and drop it
+        from the hot table. Returns the number of archived messages.
+    """
+    conversations = list(ChatOpinionConversation.objects.select_for_update()
+                         .filter(booking_id=booking_id).order_by('-created'))
+    if not conversations:
+        return 0
+    archive, created = ChatOpinionArchive.objects.select_for_update(
+    ).get_or_create(booking_id=booking_id, defaults={'data': b''})
+    messages = serialize_conversations(conversations)
+    if not created:
+        messages = sorted(messages + archive.messages,
+                          key=lambda message: message['created'],
+                          reverse=True)
+    archive.messages = messages
+    archive.save()
+    ChatOpinionConversation.objects.filter(
+        pk__in=[conversation.pk for conversation in conversations]).delete()
+    return len(conversations)
+
+
+def archivable_bookings(days=ARCHIVE_AFTER_DAYS):
+    cutoff = timezone.now() - timedelta(days=days)
+    return booking.objects.filter(
+        status__in=CLOSED_STATUSES,
+        booking_conversation__isnull=False,
+    ).annotate(
+        last_message=Max('booking_conversation__created')
+    ).filter(last_message__lt=cutoff)
+
+
+def archive_closed_conversations(days=ARCHIVE_AFTER_DAYS, batch_size=100,
+                                 dry_run=False):
+    """
+        Archive the conversations of completed/cancelled bookings without
+        messages for ``days``, walking the bookings by primary key so every
+        batch is a short transaction. Yields ``(booking_id, messages)``.
+    """
+    queryset = archivable_bookings(days).order_by('pk')
+    last_pk = 0
+    while True:
+        booking_ids = list(queryset.filter(pk__gt=last_pk).values_list(
+            'pk', flat=True)[:batch_size])
+        if not booking_ids:
+            break
+        for booking_id in booking_ids:
+            if dry_run:
+                count = ChatOpinionConversation.objects.filter(
+                    booking_id=booking_id).count()
+            else:
+                count = archive_booking(booking_id)
+            yield booking_id, count
+        last_pk = booking_ids[-1]
+
+
+def archived_messages(archive):
+    """
+        Archived messages with the timestamps parsed back, newest first
+        like the hot table.
+    """
+    messages = archive.messages
+    for message in messages:
+        message['created'] = parse_datetime(message['created'])
+        message['modified'] = parse_datetime(message['modified'])
+    return messages
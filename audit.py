@@ -0,0 +1,33 @@
+import json
+
+from auditlog.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.utils.encoding import force_text
+
+
+def log_bulk_update(model, changes, actor=None):
+    """
+        Write the auditlog entries of a queryset ``update()`` in one
+        INSERT, the way auditlog would have logged a ``save()`` per row.
+
+        ``changes`` maps a primary key to ``{field: (old, new)}``.
+    """
+    if not changes:
+        return []
+    content_type = ContentType.objects.get_for_model(model)
+    verbose_name = force_text(model._meta.verbose_name)
+    entries = []
+    for pk, fields in changes.items():
+        entries.append(LogEntry(
+            content_type=content_type,
+            object_pk=force_text(pk),
+            object_id=pk if isinstance(pk, int) else None,
+            object_repr=f'{verbose_name} {pk}',
+            action=LogEntry.Action.UPDATE,
+            changes=json.dumps({
+                field: [force_text(old), force_text(new)]
+                for field, (old, new) in fields.items()
+            }),
+            actor=actor if actor and actor.is_authenticated else None,
+        ))
+    return LogEntry.objects.bulk_create(entries)
@@ -0,0 +1,96 @@
+import csv
+import json
+from datetime import timedelta
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ChatOptionAnswer, Complaint
+
+
+CHUNK_SIZE = 2000
+
+# dataset -> (model, watermark field, flat columns)
+DATASETS = {
+    'complaints': (Complaint, 'modified', (
+        'id', 'created', 'modified', 'type', 'description', 'user_id',
+        'booking_id', 'booking__status', 'booking__doctor_id',
+        'booking__patient_id',
+    )),
+    'answers': (ChatOptionAnswer, 'id', (
+        'id', 'question_id', 'questionnaire_version__number',
+        'question_code', 'question_label', 'answer',
+        'basket_id', 'booking_id', 'booking__status', 'booking__doctor_id',
+        'booking__patient_id',
+    )),
+}
+
+# watermark field -> how far before the last watermark rows are read again.
+# ``modified`` is set and ids are handed out before the transaction commits,
+# so a row can become visible after an export already went past it.
+OVERLAP = {
+    'modified': timedelta(minutes=15),
+    'id': 1000,
+}
+
+
+def parse_watermark(dataset, value):
+    """
+        Watermark of a dataset from its text form: an id for answers, a
+        datetime for complaints (made aware in the current time zone when
+        it has none). Raises ValueError when it is not one.
+    """
+    if DATASETS[dataset][1] == 'id':
+        if not value.isdigit():
+            raise ValueError(f'Invalid id watermark: {value}')
+        return int(value)
+    # None when malformed, ValueError for a day like 2021-02-30
+    since = parse_datetime(value)
+    if since is None:
+        raise ValueError(f'Invalid datetime watermark: {value}')
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def export_rows(dataset, since=None, chunk_size=CHUNK_SIZE):
+    """
+        Flat dicts of a dataset ordered by (watermark, id), read with a
+        server-side cursor. ``since`` is the last exported watermark
+        (``modified`` for complaints, ``id`` for answers). The OVERLAP
+        window before it is read again to catch rows committed late, so
+        rows can repeat: deduplicate them on (id, watermark).
+    """
+    model, watermark, columns = DATASETS[dataset]
+    queryset = model.objects.all()
+    if since is not None:
+        queryset = queryset.filter(
+            **{f'{watermark}__gt': since - OVERLAP[watermark]})
+    queryset = queryset.order_by(watermark, 'id').values(*columns)
+    return queryset.iterator(chunk_size=chunk_size)
+
+
+class _Echo(object):
+    # csv.writer target that hands the line back instead of storing it
+    def write(self, value):
+        return value
+
+
+def csv_lines(dataset, rows):
+    columns = DATASETS[dataset][2]
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for row in rows:
+        yield writer.writerow([row[column] for column in columns])
+
+
+def jsonl_lines(dataset, rows):
+    for row in rows:
+        yield json.dumps(row, cls=DjangoJSONEncoder) + '\n'
+
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'jsonl': (jsonl_lines, 'application/x-ndjson'),
+}
@@ -0,0 +1,151 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils.translation import get_language
+
+from config.models import Speciality, bookingFee
+from core.models import Service
+from doctor.models import Doctor
+
+
+CACHE_PREFIX = 'chat_opinion'
+CACHE_TIMEOUT = getattr(settings, 'CHAT_OPINION_CACHE_TIMEOUT', 60 * 60)
+CHAT_OPINION_SERVICE_SLUG = 'Chat-opinion'
+
+# cached ``None`` must be told apart from a cache miss
+_MISSING = object()
+_NONE = '__none__'
+
+
+def _version_key(namespace):
+    return f'{CACHE_PREFIX}:version:{namespace}'
+
+
+def get_namespace_version(namespace):
+    """
+        Current generation of a cache namespace. Keys are built on top of
+        it so a whole namespace can be dropped with a single bump.
+    """
+    version = cache.get(_version_key(namespace))
+    if version is None:
+        version = 1
+        cache.add(_version_key(namespace), version, None)
+    return version
+
+
+def bump_namespace(namespace):
+    try:
+        cache.incr(_version_key(namespace))
+    except ValueError:
+        cache.set(_version_key(namespace), 2, None)
+
+
+def make_key(namespace, *parts):
+    version = get_namespace_version(namespace)
+    suffix = ':'.join(str(part) for part in parts)
+    return f'{CACHE_PREFIX}:{namespace}:{version}:{suffix}'
+
+
+def get_speciality_facets(language=None):
+    """
+        Specialities that have at least one active Chat-opinion doctor,
+        with the number of such doctors, ordered by name.
+
+        The result is cached per language and dropped when a doctor or a
+        speciality changes (see signals.py).
+    """
+    language = language or get_language()
+    key = make_key('facets', 'speciality', language)
+    facets = cache.get(key)
+    if facets is None:
+        specialities = Speciality.objects.specialities().filter(
+            doctor_specialities__is_deleted=False,
+            doctor_specialities__user__is_active=True,
+            doctor_specialities__Chat_opinion=True
+        ).annotate(
+            doctor_count=Count('doctor_specialities', distinct=True)
+        ).order_by('name')
+        facets = [
+            {'id': speciality.pk, 'slug': speciality.slug,
+             'name': speciality.name,
+             'doctor_count': speciality.doctor_count}
+            for speciality in specialities
+        ]
+        cache.set(key, facets, CACHE_TIMEOUT)
+    return facets
+
+
+def invalidate_speciality_facets():
+    bump_namespace('facets')
+
+
+def _request_memo(request):
+    if request is None:
+        return None
+    memo = getattr(request, '_chat_opinion_references', None)
+    if memo is None:
+        memo = request._chat_opinion_references = {}
+    return memo
+
+
+def _reference(request, namespace, key, loader):
+    """
+        Look a reference object up in the request memo, then in the
+        process-level cache and finally in the database.
+    """
+    memo = _request_memo(request)
+    memo_key = (namespace, key)
+    if memo is not None and memo_key in memo:
+        return memo[memo_key]
+
+    cache_key = make_key(namespace, key)
+    value = cache.get(cache_key, _MISSING)
+    if value is _MISSING:
+        value = loader()
+        cache.set(cache_key, _NONE if value is None else value, CACHE_TIMEOUT)
+    elif value == _NONE:
+        value = None
+
+    if memo is not None:
+        memo[memo_key] = value
+    return value
+
+
+def get_booking_fee(request=None):
+    return _reference(request, 'booking_fee', 'solo', bookingFee.get_solo)
+
+
+def get_chat_opinion_service(request=None):
+    return _reference(
+        request, 'service', CHAT_OPINION_SERVICE_SLUG,
+        lambda: Service.objects.filter(slug=CHAT_OPINION_SERVICE_SLUG).first()
+    )
+
+
+def get_speciality(slug, request=None):
+    if not slug:
+        return None
+    return _reference(
+        request, 'speciality', slug,
+        lambda: Speciality.objects.filter(slug=slug).first()
+    )
+
+
+def get_doctor(slug, request=None):
+    """
+        Doctors are only memoized for the request: their fees and
+        availability have to be fresh on every page.
+    """
+    memo = _request_memo(request)
+    memo_key = ('doctor', slug)
+    if memo is not None and memo_key in memo:
+        return memo[memo_key]
+    doctor = Doctor.objects.select_related('hospital', 'user').get(
+        user__slug=slug)
+    if memo is not None:
+        memo[memo_key] = doctor
+    return doctor
+
+
+def invalidate_references(namespace):
+    bump_namespace(namespace)
@@ -0,0 +1,145 @@
+import mimetypes
+import os
+import re
+import unicodedata
+from urllib.parse import quote
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
+from wagtail.documents.models import get_document_model
+
+from booking.models import booking
+from .models import ChatOpinionArchive
+
+
+# Chat attachments and their previews live under MEDIA_ROOT/documents/. The
+# API only hands out the protected download URLs, the front-end server must
+# not serve that directory publicly (an ``internal`` nginx location, see
+# SENDFILE_URL), otherwise a leaked media link bypasses the checks below.
+
+# 'nginx' (X-Accel-Redirect), 'apache' (X-Sendfile) or None to stream
+SENDFILE_BACKEND = getattr(settings, 'CHAT_OPINION_SENDFILE_BACKEND', None)
+# internal nginx location aliased to MEDIA_ROOT
+SENDFILE_URL = getattr(settings, 'CHAT_OPINION_SENDFILE_URL', '/protected/')
+CHUNK_SIZE = 64 * 1024
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# a byte range outside the file, answered with a 416
+UNSATISFIABLE = object()
+
+
+def get_booking_document(user, booking_id, document_id):
+    """
+        The document if it is attached to the booking (case or chat
+        attachment) and the user takes part in that booking, else None.
+        A single query, plus an archive lookup for archived threads.
+    """
+    bookings = booking.objects.filter(pk=booking_id).filter(
+        Q(user=user) | Q(patient__parent=user) | Q(doctor__user=user)
+    ).values('pk')
+    case_attachments = booking._meta.get_field(
+        'attachments').related_query_name()
+    Document = get_document_model()
+    document = Document.objects.filter(pk=document_id).filter(
+        Q(conversation_doctor_attachments__booking__in=bookings) |
+        Q(conversation_patient_attachments__booking__in=bookings) |
+        Q(**{f'{case_attachments}__in': bookings})
+    ).first()
+    if document is not None:
+        return document
+
+    archive = ChatOpinionArchive.objects.filter(booking__in=bookings).first()
+    if archive is not None and any(
+            int(document_id) in message['doctor_attachments'] +
+            message['patient_attachments'] for message in archive.messages):
+        return Document.objects.filter(pk=document_id).first()
+    return None
+
+
+def _file_chunks(file, start, length):
+    with file.open('rb') as source:
+        source.seek(start)
+        while length > 0:
+            chunk = source.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def _range(header, size):
+    """
+        (start, end) of a single byte range, UNSATISFIABLE when it is
+        outside the file and None when the header is not a single byte
+        range: multiple or malformed ranges are ignored and the whole file
+        is sent, as RFC 7233 allows.
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    start, end = match.groups()
+    if start == '':
+        # suffix range: the last N bytes
+        start, end = max(size - int(end), 0), size - 1
+    else:
+        start, end = int(start), min(int(end), size - 1) if end else size - 1
+    if start > end or start >= size:
+        return UNSATISFIABLE
+    return start, end
+
+
+def content_disposition(name, as_attachment=True):
+    """
+        Content-Disposition header value for a file name: an escaped ASCII
+        ``filename`` for old clients plus the exact name percent-encoded in
+        ``filename*`` (RFC 6266).
+    """
+    disposition = 'attachment' if as_attachment else 'inline'
+    fallback = unicodedata.normalize('NFKD', name).encode(
+        'ascii', 'ignore').decode('ascii')
+    fallback = ''.join(char for char in fallback if char.isprintable())
+    fallback = fallback.replace('\\', '\\\\').replace('"', '\\"')
+    return (f'{disposition}; filename="{fallback or "download"}"; '
+            f"filename*=UTF-8''{quote(name, safe='')}")
+
+
+def serve_file(request, file, as_attachment=True):
+    """
+        Hand the transfer to the front-end server when
+        CHAT_OPINION_SENDFILE_BACKEND is set (it deals with ranges then),
+        otherwise stream the file honouring a single Range header.
+    """
+    name = os.path.basename(file.name)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    if SENDFILE_BACKEND == 'nginx':
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = SENDFILE_URL + quote(file.name)
+    elif SENDFILE_BACKEND == 'apache':
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = file.path
+    else:
+        size = file.size
+        header = request.META.get('HTTP_RANGE', '')
+        byte_range = _range(header, size) if header else None
+        if byte_range is UNSATISFIABLE:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        if byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                _file_chunks(file, start, end - start + 1),
+                status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = end - start + 1
+        else:
+            response = StreamingHttpResponse(
+                _file_chunks(file, 0, size),
+                content_type=content_type)
+            response['Content-Length'] = size
+        response['Accept-Ranges'] = 'bytes'
+
+    response['Content-Disposition'] = content_disposition(name, as_attachment)
+    response['Cache-Control'] = 'private'
+    return response
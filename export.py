@@ -0,0 +1,129 @@
+import os
+import zipfile
+
+from django.utils import timezone
+from django.utils.text import get_valid_filename
+from wagtail.documents.models import get_document_model
+
+from .archive import archived_messages
+from .models import ChatOpinionArchive, ChatOpinionConversation, ChatOptionAnswer
+from .questionnaires import answer_label
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _StreamBuffer(object):
+    """
+        Write-only file object handed to ZipFile. It has no ``tell`` or
+        ``seek`` so zipfile writes data descriptors instead of seeking back,
+        and whatever was written is popped after every chunk.
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _conversation_rows(instance):
+    conversations = ChatOpinionConversation.objects.filter(
+        booking=instance
+    ).order_by('created').prefetch_related('doctor_attachments',
+                                           'patient_attachments')
+    rows = []
+    for conversation in conversations:
+        rows.append((conversation.created, conversation.is_doctor_message,
+                     conversation.message,
+                     list(conversation.doctor_attachments.all()) +
+                     list(conversation.patient_attachments.all())))
+    if rows:
+        return rows
+
+    archive = ChatOpinionArchive.objects.filter(booking=instance).first()
+    if archive is None:
+        return rows
+    messages = archived_messages(archive)
+    documents = get_document_model().objects.in_bulk({
+        pk for message in messages
+        for pk in message['doctor_attachments'] + message['patient_attachments']
+    })
+    for message in reversed(messages):
+        rows.append((message['created'], message['is_doctor_message'],
+                     message['message'],
+                     [documents[pk] for pk in message['doctor_attachments'] +
+                      message['patient_attachments'] if pk in documents]))
+    return rows
+
+
+def _attachment_name(folder, document, used):
+    name = get_valid_filename(os.path.basename(document.file.name)) or 'file'
+    path = f'attachments/{folder}/{name}'
+    if path in used:
+        path = f'attachments/{folder}/{document.pk}-{name}'
+    used.add(path)
+    return path
+
+
+def iter_case_zip(instance):
+    """
+        Stream a ZIP of a Chat-opinion case: transcript, questionnaire
+        answers and every attachment. Attachments are copied in CHUNK_SIZE
+        pieces, so memory stays flat whatever their size.
+    """
+    buffer = _StreamBuffer()
+    archive = zipfile.ZipFile(buffer, mode='w')
+
+    answers = ChatOptionAnswer.objects.filter(booking=instance).order_by('pk')
+    lines = []
+    for answer in answers:
+        lines.append(f'Q: {answer_label(answer)}\nA: {answer.answer or ""}\n')
+    archive.writestr('answers.txt', '\n'.join(lines),
+                     compress_type=zipfile.ZIP_DEFLATED)
+    yield buffer.pop()
+
+    rows = _conversation_rows(instance)
+    lines = []
+    for created, is_doctor_message, message, attachments in rows:
+        sender = 'Doctor' if is_doctor_message else 'Patient'
+        created = timezone.localtime(created).strftime('%Y-%m-%d %H:%M')
+        lines.append(f'[{created}] {sender}: {message}')
+        for document in attachments:
+            lines.append(f'    attachment: {document.title}')
+    archive.writestr('transcript.txt', '\n'.join(lines) + '\n',
+                     compress_type=zipfile.ZIP_DEFLATED)
+    yield buffer.pop()
+
+    used = set()
+    documents = [('case', document) for document in instance.attachments.all()]
+    documents += [('messages', document)
+                  for row in rows for document in row[3]]
+    for folder, document in documents:
+        path = _attachment_name(folder, document, used)
+        info = zipfile.ZipInfo(path, date_time=timezone.localtime(
+            document.created_at).timetuple()[:6])
+        # scans and pictures are already compressed
+        info.compress_type = zipfile.ZIP_STORED
+        with document.file.open('rb') as source, \
+                archive.open(info, mode='w', force_zip64=True) as target:
+            while True:
+                chunk = source.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                target.write(chunk)
+                if buffer.chunks:
+                    yield buffer.pop()
+        yield buffer.pop()
+
+    archive.close()
+    yield buffer.pop()
@@ -0,0 +1,148 @@
+import base64
+
+from django.db import transaction
+from django.db.models import OuterRef, Q, Subquery
+from django.db.models.functions import Substr
+from django.utils.dateparse import parse_datetime
+
+from booking.models import booking
+from core.choices import IN_PROGRESS, NEW
+from .cache import get_chat_opinion_service
+from .models import ChatOpinionConversation, InboxThread
+
+
+ACTIVE_STATUSES = (NEW, IN_PROGRESS)
+SNIPPET_LENGTH = InboxThread._meta.get_field('last_message').max_length
+
+
+def encode_cursor(last_activity, pk):
+    value = f'{last_activity.isoformat()}|{pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    """ (last activity, pk) of a cursor, None when it is malformed. """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        last_activity, pk = value.rsplit('|', 1)
+        last_activity = parse_datetime(last_activity)
+        return (last_activity, int(pk)) if last_activity else None
+    except (ValueError, UnicodeError):
+        return None
+
+
+def _message_values(message, created):
+    """ InboxThread fields for a last ``message``, None if there is none. """
+    if message is None:
+        return {'last_activity': created, 'last_message': '',
+                'last_is_doctor_message': None, 'last_message_at': None}
+    return {'last_activity': message.created,
+            'last_message': message.message[:SNIPPET_LENGTH],
+            'last_is_doctor_message': message.is_doctor_message,
+            'last_message_at': message.created}
+
+
+def _last_message(booking_id):
+    return ChatOpinionConversation.objects.filter(
+        booking_id=booking_id).order_by('-created', '-pk').first()
+
+
+def booking_changed(instance):
+    """
+        Add, move or drop the inbox row of a booking after a save: only
+        active Chat-opinion bookings with a doctor have one.
+    """
+    service = get_chat_opinion_service()
+    if service is None or instance.service_type_id != service.pk:
+        return
+    threads = InboxThread.objects.filter(booking_id=instance.pk)
+    if instance.status not in ACTIVE_STATUSES or not instance.doctor_id:
+        threads.delete()
+        return
+    if threads.update(doctor_id=instance.doctor_id):
+        return
+    values = _message_values(_last_message(instance.pk), instance.created)
+    with transaction.atomic():
+        InboxThread.objects.get_or_create(
+            booking_id=instance.pk,
+            defaults=dict(values, doctor_id=instance.doctor_id))
+
+
+def message_added(message):
+    # an older message saved late must not hide the newer one
+    InboxThread.objects.filter(booking_id=message.booking_id).filter(
+        Q(last_message_at__isnull=True) |
+        Q(last_message_at__lte=message.created)
+    ).update(**_message_values(message, message.created))
+
+
+def message_removed(message):
+    thread = InboxThread.objects.select_related('booking').filter(
+        booking_id=message.booking_id).first()
+    if thread is not None:
+        InboxThread.objects.filter(pk=thread.pk).update(**_message_values(
+            _last_message(message.booking_id), thread.booking.created))
+
+
+def rebuild_inbox(batch_size=500):
+    """
+        Recreate every inbox row from the bookings and their messages, to
+        fill the table on the first deploy or repair it. Returns the number
+        of rows.
+    """
+    last = ChatOpinionConversation.objects.filter(
+        booking=OuterRef('pk')).order_by('-created', '-pk')
+    bookings = booking.objects.filter(
+        service_type__slug='Chat-opinion', status__in=ACTIVE_STATUSES,
+        doctor__isnull=False
+    ).annotate(
+        last_message=Subquery(last.annotate(
+            snippet=Substr('message', 1, SNIPPET_LENGTH)).values('snippet')[:1]),
+        last_is_doctor_message=Subquery(
+            last.values('is_doctor_message')[:1]),
+        last_message_at=Subquery(last.values('created')[:1]),
+    ).values_list('pk', 'doctor_id', 'created', 'last_message',
+                  'last_is_doctor_message', 'last_message_at')
+
+    threads = [
+        InboxThread(booking_id=pk, doctor_id=doctor_id,
+                    last_activity=last_message_at or created,
+                    last_message=last_message or '',
+                    last_is_doctor_message=last_is_doctor_message,
+                    last_message_at=last_message_at)
+        for pk, doctor_id, created, last_message, last_is_doctor_message,
+        last_message_at in bookings.iterator()
+    ]
+    with transaction.atomic():
+        InboxThread.objects.all().delete()
+        InboxThread.objects.bulk_create(threads, batch_size=batch_size)
+    return len(threads)
+
+
+def doctor_inbox(user, cursor=None, limit=20):
+    """
+        Active Chat-opinion threads of a doctor with their last message,
+        most recent activity first. Reads the InboxThread rows in the
+        order of their (doctor, last activity) index and pages them by
+        keyset on (last activity, booking), so a page costs the same for
+        a doctor with ten cases or ten thousand.
+
+        Returns ``(threads, next cursor)``.
+    """
+    queryset = InboxThread.objects.filter(doctor__user=user).select_related(
+        'booking__patient').order_by('-last_activity', '-booking')
+
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        last_activity, pk = position
+        queryset = queryset.filter(
+            Q(last_activity__lt=last_activity) |
+            Q(last_activity=last_activity, booking__lt=pk))
+
+    threads = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(threads) > limit:
+        threads = threads[:limit]
+        next_cursor = encode_cursor(threads[-1].last_activity,
+                                    threads[-1].booking_id)
+    return threads, next_cursor
@@ -0,0 +1,177 @@
+import logging
+import random
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger('Chat_opinion.metrics')
+
+# 0 disables the instrumentation, 1 measures every request
+SAMPLE_RATE = getattr(settings, 'CHAT_OPINION_METRICS_SAMPLE_RATE', 0)
+SERVER_TIMING = getattr(settings, 'CHAT_OPINION_METRICS_SERVER_TIMING', True)
+LOG_REQUESTS = getattr(settings, 'CHAT_OPINION_METRICS_LOG', False)
+NAMESPACES = ('Chat_opinion', 'chatting_api')
+
+REQUEST_ATTR = '_chat_opinion_metrics'
+
+_lock = threading.Lock()
+# view name -> accumulated totals, exposed by ``prometheus_text``
+_totals = {}
+# (metric name, label) -> counter, see ``increment``
+_counters = {}
+
+
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.view = None
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - start
+
+
+def get_metrics(request):
+    # works for both django and rest_framework requests
+    return getattr(request, REQUEST_ATTR, None) if request is not None else None
+
+
+@contextmanager
+def measure_serializer(request):
+    metrics = get_metrics(request)
+    if metrics is None or metrics.serializer_depth:
+        # off, or already measured by an outer serializer
+        yield
+        return
+    metrics.serializer_depth += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serializer_time += time.perf_counter() - start
+        metrics.serializer_depth -= 1
+
+
+class TimedSerializerMixin(object):
+    """ Accounts the rendering time of a serializer to its request. """
+
+    def to_representation(self, instance):
+        with measure_serializer(self.context.get('request', None)):
+            return super(TimedSerializerMixin, self).to_representation(
+                instance)
+
+
+def increment(name, label, value=1):
+    with _lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + value
+
+
+def _record(metrics, duration, size):
+    with _lock:
+        totals = _totals.setdefault(metrics.view, {
+            'requests': 0, 'duration': 0.0, 'queries': 0, 'db_time': 0.0,
+            'serializer_time': 0.0, 'bytes': 0})
+        totals['requests'] += 1
+        totals['duration'] += duration
+        totals['queries'] += metrics.queries
+        totals['db_time'] += metrics.db_time
+        totals['serializer_time'] += metrics.serializer_time
+        totals['bytes'] += size
+
+
+def prometheus_text():
+    """ Totals of this process in the Prometheus text exposition format. """
+    with _lock:
+        totals = {view: dict(values) for view, values in _totals.items()}
+        counters = dict(_counters)
+
+    lines = []
+    metrics = (
+        ('requests', 'chat_opinion_requests_total', 'counter'),
+        ('duration', 'chat_opinion_request_seconds_total', 'counter'),
+        ('queries', 'chat_opinion_db_queries_total', 'counter'),
+        ('db_time', 'chat_opinion_db_seconds_total', 'counter'),
+        ('serializer_time', 'chat_opinion_serializer_seconds_total', 'counter'),
+        ('bytes', 'chat_opinion_response_bytes_total', 'counter'),
+    )
+    for key, name, kind in metrics:
+        lines.append(f'# TYPE {name} {kind}')
+        for view, values in sorted(totals.items()):
+            lines.append(f'{name}{{view="{view}"}} {values[key]}')
+    for name in sorted({name for name, label in counters}):
+        lines.append(f'# TYPE {name} counter')
+        for (counter, label), value in sorted(counters.items()):
+            if counter == name:
+                lines.append(f'{name}{{scope="{label}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+class ChatOpinionMetricsMiddleware(object):
+    """
+        Per view query count, DB time, serializer time and payload size of
+        the Chat-opinion views, reported as a ``Server-Timing`` header, in
+        the ``prometheus_text`` totals and optionally as a log record.
+
+        Add ``Chat_opinion.instrumentation.ChatOpinionMetricsMiddleware``
+        to MIDDLEWARE and set CHAT_OPINION_METRICS_SAMPLE_RATE. Requests
+        that are not sampled only pay for one random() call.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not SAMPLE_RATE or random.random() >= SAMPLE_RATE:
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        setattr(request, REQUEST_ATTR, metrics)
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(
+                    connection.execute_wrapper(metrics.execute_wrapper))
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        if metrics.view is None:
+            return response
+        size = 0 if response.streaming else len(response.content)
+        _record(metrics, duration, size)
+
+        if SERVER_TIMING:
+            response['Server-Timing'] = ', '.join((
+                f'db;dur={metrics.db_time * 1000:.1f};desc="{metrics.queries} queries"',
+                f'serializer;dur={metrics.serializer_time * 1000:.1f}',
+                f'total;dur={duration * 1000:.1f}',
+            ))
+        if LOG_REQUESTS:
+            logger.info('%s', metrics.view, extra={
+                'view': metrics.view, 'duration': duration,
+                'queries': metrics.queries, 'db_time': metrics.db_time,
+                'serializer_time': metrics.serializer_time, 'bytes': size,
+                'status': response.status_code,
+            })
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        metrics = get_metrics(request)
+        if metrics is None:
+            return None
+        match = request.resolver_match
+        if match and any(namespace in NAMESPACES
+                         for namespace in match.namespaces):
+            metrics.view = f'{match.view_name}:{request.method}'
+        return None
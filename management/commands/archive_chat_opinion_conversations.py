@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from Chat_opinion.archive import ARCHIVE_AFTER_DAYS, archive_closed_conversations
+
+
+class Command(BaseCommand):
+    help = ('Move conversations of completed/cancelled Chat-opinion bookings '
+            'into compressed archive rows. Meant to be run from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                            help='Archive threads idle for more than this '
+                                 'many days (default: %(default)s)')
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be archived')
+
+    def handle(self, *args, **options):
+        bookings = messages = 0
+        for booking_id, count in archive_closed_conversations(
+                days=options['days'], batch_size=options['batch_size'],
+                dry_run=options['dry_run']):
+            bookings += 1
+            messages += count
+            if options['verbosity'] > 1:
+                self.stdout.write(f'booking {booking_id}: {count} messages')
+
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {messages} messages of {bookings} bookings'))
@@ -0,0 +1,164 @@
+import json
+import statistics
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import (
+    CaptureQueriesContext, override_settings, setup_test_environment,
+    teardown_test_environment
+)
+from django.urls import reverse
+
+from booking.models import booking
+
+from Chat_opinion.models import ChatOpinionQuestion
+from .generate_chat_opinion_data import synthetic_users
+
+
+FLOWS = ('dashboard', 'chat_fetch', 'chat_post', 'case_submission')
+DASHBOARD_STATUSES = ('new', 'in-progress', 'reply', 'closed')
+
+
+def percentile(values, percent):
+    # nearest-rank percentile, good enough for a few hundred samples
+    values = sorted(values)
+    index = max(0, int(round(percent / 100.0 * len(values))) - 1)
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = ('Replay the hot Chat-opinion flows through the Django test client '
+            'against the synthetic dataset (see generate_chat_opinion_data) '
+            'and report latency percentiles, queries per request and memory. '
+            'Writes to the database: run it on a disposable copy.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--flows', default=','.join(FLOWS),
+                            help='Comma separated subset of: %s' % ', '.join(FLOWS))
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--json', action='store_true',
+                            help='Print the report as JSON')
+        parser.add_argument('--throttle', action='store_true',
+                            help='Keep the chat post and upload throttles on; '
+                                 'refused posts are then counted as errors')
+
+    def handle(self, *args, **options):
+        flows = [flow.strip() for flow in options['flows'].split(',') if flow]
+        unknown = set(flows) - set(FLOWS)
+        if unknown:
+            raise CommandError(f"Unknown flows: {', '.join(sorted(unknown))}")
+
+        instance = booking.objects.select_related(
+            'doctor__user', 'patient__parent'
+        ).filter(doctor__user__in=synthetic_users(),
+                 status='in-progress').order_by('pk').first()
+        if instance is None:
+            raise CommandError('No synthetic in-progress booking, run '
+                               'generate_chat_opinion_data first')
+        self.booking = instance
+        self.question_codes = list(
+            ChatOpinionQuestion.objects.values_list('code', flat=True))
+
+        # testserver host, in-memory emails: nothing leaves the machine.
+        # The flows post far faster than the throttles allow, time the
+        # views rather than 429 responses unless asked otherwise.
+        setup_test_environment()
+        throttles = override_settings(
+            CHAT_OPINION_THROTTLE_ENABLED=options['throttle'])
+        throttles.enable()
+        try:
+            self.doctor_client = Client()
+            self.doctor_client.force_login(instance.doctor.user)
+            self.patient_client = Client()
+            self.patient_client.force_login(instance.patient.parent)
+            report = {flow: self.run(flow, options) for flow in flows}
+        finally:
+            throttles.disable()
+            teardown_test_environment()
+
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(f"{'flow':<18}{'p50 ms':>9}{'p99 ms':>9}"
+                          f"{'queries':>9}{'peak KiB':>10}{'errors':>8}")
+        for flow, result in report.items():
+            self.stdout.write(
+                f"{flow:<18}{result['p50_ms']:>9.1f}{result['p99_ms']:>9.1f}"
+                f"{result['queries']:>9.1f}{result['peak_kib']:>10.0f}"
+                f"{result['errors']:>8}")
+
+    def run(self, flow, options):
+        request = getattr(self, f'request_{flow}')
+        for n in range(options['warmup']):
+            request(n)
+
+        latencies, queries, errors = [], [], 0
+        for n in range(options['iterations']):
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = request(n)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+            if response.status_code >= 400:
+                errors += 1
+
+        # tracemalloc slows everything down, keep it out of the timings
+        peaks = []
+        for n in range(min(5, options['iterations'])):
+            tracemalloc.start()
+            request(n)
+            peaks.append(tracemalloc.get_traced_memory()[1] / 1024)
+            tracemalloc.stop()
+
+        return {
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99),
+            'mean_ms': statistics.mean(latencies),
+            'queries': statistics.mean(queries),
+            'peak_kib': max(peaks) if peaks else 0,
+            'errors': errors,
+        }
+
+    def request_dashboard(self, n):
+        status = DASHBOARD_STATUSES[n % len(DASHBOARD_STATUSES)]
+        return self.doctor_client.get(
+            reverse('chatting_api:chat-opinion-list'), {'status': status})
+
+    def request_chat_fetch(self, n):
+        return self.patient_client.get(reverse('chatting_api:chat-list'),
+                                       {'booking': self.booking.pk})
+
+    def request_chat_post(self, n):
+        return self.doctor_client.post(
+            reverse('chatting_api:chat-list'),
+            data=json.dumps({
+                'patient': self.booking.patient_id,
+                'doctor': self.booking.doctor_id,
+                'booking': self.booking.pk,
+                'message': f'benchmark message {n}',
+            }),
+            content_type='application/json'
+        )
+
+    def request_case_submission(self, n):
+        doctor = self.booking.doctor
+        data = {code: f'benchmark answer {n}' for code in self.question_codes}
+        data.update({
+            'basket-doctor': doctor.pk,
+            'basket-hospital': doctor.hospital_id or '',
+            'basket-user': self.booking.user_id,
+            'basket-status': 'new',
+            'basket-fee': 0,
+            'basket-doctor_fees': doctor.Chat_opinion_fees,
+            'basket-total': doctor.Chat_opinion_fees,
+            'patient': self.booking.patient_id,
+        })
+        return self.patient_client.post(
+            reverse('Chat_opinion:case_detail',
+                    kwargs={'slug': doctor.user.slug}),
+            data, HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+        )
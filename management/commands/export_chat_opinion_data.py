@@ -0,0 +1,105 @@
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Chat_opinion.bulk_export import (
+    DATASETS, FORMATS, OVERLAP, export_rows, parse_watermark
+)
+
+
+class Command(BaseCommand):
+    help = ('Stream complaints or questionnaire answers as CSV/JSONL for '
+            'analytics. With --state-file only rows newer than the last run '
+            'are exported: the state keeps the watermark and the ids of the '
+            'overlap window, so rows committed late are picked up once.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--since', default=None,
+                            help='Watermark to start after: a datetime for '
+                                 'complaints, an id for answers')
+        parser.add_argument('--state-file', default=None,
+                            help='File keeping the watermark between runs')
+        parser.add_argument('--output', default='-',
+                            help='Output file, - for stdout')
+        parser.add_argument('--chunk-size', type=int, default=2000)
+
+    def parse_since(self, dataset, value):
+        if value is None or value == '':
+            return None
+        try:
+            return parse_watermark(dataset, value)
+        except ValueError as error:
+            raise CommandError(str(error))
+
+    def format_watermark(self, value):
+        return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+    def read_state(self, dataset, path):
+        """ (watermark, {id: watermark}) saved by the previous run. """
+        try:
+            with open(path) as state:
+                content = state.read().strip()
+        except FileNotFoundError:
+            return None, {}
+        try:
+            state = json.loads(content)
+        except ValueError:
+            # a bare watermark, as written by earlier versions
+            return self.parse_since(dataset, content), {}
+        seen = {int(pk): self.parse_since(dataset, value)
+                for pk, value in state.get('seen', {}).items()}
+        return self.parse_since(dataset, state.get('watermark')), seen
+
+    def write_state(self, path, watermark, seen):
+        with open(path, 'w') as state:
+            json.dump({
+                'watermark': self.format_watermark(watermark),
+                'seen': {str(pk): self.format_watermark(value)
+                         for pk, value in seen.items()},
+            }, state)
+
+    def handle(self, *args, **options):
+        dataset = options['dataset']
+        since, seen = None, {}
+        if options['since'] is not None:
+            since = self.parse_since(dataset, options['since'])
+        elif options['state_file']:
+            since, seen = self.read_state(dataset, options['state_file'])
+
+        watermark_field = DATASETS[dataset][1]
+        watermark = since
+        count = 0
+
+        def tracked(rows):
+            nonlocal watermark, count
+            for row in rows:
+                value = row[watermark_field]
+                if seen.get(row['id']) == value:
+                    # exported by the previous run, re-read by the overlap
+                    continue
+                seen[row['id']] = value
+                if watermark is None or value > watermark:
+                    watermark = value
+                count += 1
+                yield row
+
+        lines, _ = FORMATS[options['format']]
+        rows = tracked(export_rows(dataset, since, options['chunk_size']))
+        output = sys.stdout if options['output'] == '-' else \
+            open(options['output'], 'w', newline='')
+        try:
+            for line in lines(dataset, rows):
+                output.write(line)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+        if options['state_file'] and watermark is not None:
+            # only the ids still inside the next overlap window matter
+            low = watermark - OVERLAP[watermark_field]
+            self.write_state(options['state_file'], watermark, {
+                pk: value for pk, value in seen.items() if value > low})
+        self.stderr.write(f'Exported {count} {dataset}, watermark {watermark}')
@@ -0,0 +1,173 @@
+import random
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from wagtail.core.models import Collection
+from wagtail.documents.models import get_document_model
+
+from booking.models import booking
+from config.models import Speciality
+from core import choices
+from doctor.models import Doctor
+from patient.models import Patient
+
+from Chat_opinion.cache import get_chat_opinion_service
+from Chat_opinion.models import (
+    ChatOpinionConversation, ChatOpinionQuestion, ChatOptionAnswer
+)
+
+
+User = get_user_model()
+Document = get_document_model()
+
+# every generated user is recognisable by its username, see --flush
+SYNTHETIC_DOMAIN = 'chat-opinion.invalid'
+STATUSES = ('new', 'in-progress', 'completed', 'cancelled')
+WORDS = ('pain', 'fever', 'since', 'days', 'report', 'scan', 'dose', 'after',
+         'morning', 'please', 'check', 'attached', 'result', 'blood', 'test')
+
+
+def synthetic_users():
+    return User.objects.filter(
+        **{f'{User.USERNAME_FIELD}__endswith': f'@{SYNTHETIC_DOMAIN}'})
+
+
+class Command(BaseCommand):
+    help = ('Generate a reproducible synthetic Chat-opinion dataset (doctors, '
+            'patients, bookings, conversations with attachments and '
+            'questionnaire answers) for benchmarks and load tests.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--doctors', type=int, default=20)
+        parser.add_argument('--patients', type=int, default=200)
+        parser.add_argument('--bookings', type=int, default=1000)
+        parser.add_argument('--messages', type=int, default=8,
+                            help='Maximum messages per booking')
+        parser.add_argument('--attachment-ratio', type=float, default=0.2,
+                            help='Share of messages carrying an attachment')
+        parser.add_argument('--attachment-size', type=int, default=64 * 1024,
+                            help='Size of generated attachments in bytes')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--flush', action='store_true',
+                            help='Delete previously generated data and exit')
+
+    def handle(self, *args, **options):
+        if options['flush']:
+            self.flush()
+            return
+
+        self.random = random.Random(options['seed'])
+        self.options = options
+        self.collection = self.get_collection()
+        self.questions = list(ChatOpinionQuestion.objects.all())
+        self.service = get_chat_opinion_service()
+        self.specialities = list(Speciality.objects.all()[:10])
+
+        with transaction.atomic():
+            doctors = [self.create_doctor(n) for n in range(options['doctors'])]
+            patients = [self.create_patient(n)
+                        for n in range(options['patients'])]
+        for n in range(options['bookings']):
+            with transaction.atomic():
+                self.create_booking(self.random.choice(doctors),
+                                    self.random.choice(patients))
+            if options['verbosity'] > 1 and n and not n % 100:
+                self.stdout.write(f'{n} bookings')
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Generated {options['doctors']} doctors, "
+            f"{options['patients']} patients and "
+            f"{options['bookings']} bookings"))
+
+    def flush(self):
+        users = synthetic_users()
+        bookings = booking.objects.filter(doctor__user__in=users)
+        ChatOptionAnswer.objects.filter(booking__in=bookings).delete()
+        ChatOpinionConversation.objects.filter(booking__in=bookings).delete()
+        bookings.delete()
+        Patient.objects.filter(parent__in=users).delete()
+        Doctor.objects.filter(user__in=users).delete()
+        count, _ = users.delete()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} objects'))
+
+    def get_collection(self):
+        try:
+            return Collection.objects.get(name=SYNTHETIC_DOMAIN)
+        except Collection.DoesNotExist:
+            collection = Collection(name=SYNTHETIC_DOMAIN)
+            Collection.get_first_root_node().add_child(instance=collection)
+            return collection
+
+    def create_user(self, kind, n):
+        user = User(**{User.USERNAME_FIELD: f'{kind}-{n}@{SYNTHETIC_DOMAIN}'})
+        if User.USERNAME_FIELD != 'email' and hasattr(user, 'email'):
+            user.email = f'{kind}-{n}@{SYNTHETIC_DOMAIN}'
+        user.first_name = kind.title()
+        user.last_name = str(n)
+        user.set_unusable_password()
+        user.save()
+        return user
+
+    def create_doctor(self, n):
+        doctor = Doctor(user=self.create_user('doctor', n), Chat_opinion=True,
+                        Chat_opinion_fees=self.random.choice((50, 100, 150)),
+                        is_deleted=False)
+        doctor.save()
+        if self.specialities:
+            self.random.choice(self.specialities).doctor_specialities.add(
+                doctor)
+        return doctor
+
+    def create_patient(self, n):
+        patient = Patient(parent=self.create_user('patient', n),
+                          is_deleted=False)
+        patient.save()
+        return patient
+
+    def sentence(self, length=12):
+        return ' '.join(self.random.choice(WORDS)
+                        for _ in range(self.random.randint(3, length)))
+
+    def create_document(self, n):
+        extension = self.random.choice(('png', 'pdf'))
+        size = self.options['attachment_size']
+        content = self.random.getrandbits(size * 8).to_bytes(size, 'big')
+        document = Document(
+            title=f'Report {n}',
+            file=ContentFile(content, name=f'report-{n}.{extension}'),
+            collection=self.collection
+        )
+        document.save()
+        return document
+
+    def create_booking(self, doctor, patient):
+        instance = booking.objects.create(
+            user=patient.parent, patient=patient, doctor=doctor,
+            hospital=doctor.hospital, service_type=self.service,
+            status=self.random.choice(STATUSES),
+            fee=0, doctor_fees=doctor.Chat_opinion_fees,
+        )
+        ChatOptionAnswer.objects.bulk_create([
+            ChatOptionAnswer(question=question, question_label=question.label,
+                             answer=self.sentence(), booking=instance)
+            for question in self.questions
+        ])
+        if instance.status == choices.NEW:
+            return instance
+
+        for n in range(self.random.randint(1, self.options['messages'])):
+            is_doctor_message = bool(n % 2)
+            message = ChatOpinionConversation.objects.create(
+                booking=instance, patient=patient, doctor=doctor,
+                is_doctor_message=is_doctor_message,
+                message=self.sentence(40)
+            )
+            if self.random.random() < self.options['attachment_ratio']:
+                document = self.create_document(message.pk)
+                if is_doctor_message:
+                    message.doctor_attachments.add(document)
+                else:
+                    message.patient_attachments.add(document)
+        return instance
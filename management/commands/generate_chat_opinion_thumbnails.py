@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from wagtail.documents.models import get_document_model
+
+from Chat_opinion.thumbnails import generate_thumbnail
+
+
+class Command(BaseCommand):
+    help = ('Generate the missing previews of chat attachments. Existing, '
+            'up to date previews are kept.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=200)
+
+    def handle(self, *args, **options):
+        documents = get_document_model().objects.filter(
+            Q(conversation_doctor_attachments__isnull=False) |
+            Q(conversation_patient_attachments__isnull=False)
+        ).distinct().order_by('pk')
+        generated = last_pk = 0
+        while True:
+            batch = list(documents.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            for document in batch:
+                if generate_thumbnail(document):
+                    generated += 1
+            last_pk = batch[-1].pk
+        self.stdout.write(self.style.SUCCESS(f'{generated} previews up to date'))
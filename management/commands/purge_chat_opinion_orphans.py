@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from Chat_opinion.retention import RETENTION_DAYS, TARGETS, purge
+
+
+class Command(BaseCommand):
+    help = ('Delete orphaned questionnaire answers and chat messages of '
+            'deleted doctors in small batches. Safe to run with live traffic.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', action='append', choices=sorted(TARGETS),
+                            help='What to purge, repeatable (default: all)')
+        parser.add_argument('--days', type=int, default=RETENTION_DAYS,
+                            help='Keep doctorless conversations younger than '
+                                 'this (orphan answers have no date)')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--pause', type=float, default=0.5,
+                            help='Seconds to sleep between batches')
+        parser.add_argument('--max-batches', type=int, default=None)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only count what would be deleted')
+
+    def handle(self, *args, **options):
+        for target in options['target'] or sorted(TARGETS):
+            rows = 0
+            start = time.monotonic()
+            for count, seconds in purge(
+                    target, days=options['days'],
+                    batch_size=options['batch_size'], pause=options['pause'],
+                    dry_run=options['dry_run'],
+                    max_batches=options['max_batches']):
+                rows += count
+                if options['verbosity'] > 1:
+                    self.stdout.write(f'{target}: {count} rows in {seconds:.2f}s')
+            elapsed = time.monotonic() - start
+            verb = 'would delete' if options['dry_run'] else 'deleted'
+            rate = rows / elapsed if elapsed else 0
+            self.stdout.write(self.style.SUCCESS(
+                f'{target}: {verb} {rows} rows in {elapsed:.1f}s '
+                f'({rate:.0f} rows/s)'))
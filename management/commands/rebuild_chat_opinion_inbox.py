@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from Chat_opinion.inbox import rebuild_inbox
+
+
+class Command(BaseCommand):
+    help = ('Recreate the doctor inbox rows from the active Chat-opinion '
+            'bookings. Run once after deploying the inbox table, they are '
+            'kept up to date by signals afterwards.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = rebuild_inbox(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} inbox threads'))
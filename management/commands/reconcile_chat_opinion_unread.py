@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from Chat_opinion.unread import mark_existing_read, reconcile_counters
+
+
+class Command(BaseCommand):
+    help = ('Recompute the unread chat message counters from the messages. '
+            'On the first run after deploying the counters, pass '
+            '--mark-existing-read: older messages have no read state and '
+            'would otherwise all count as unread.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report the drifted counters')
+        parser.add_argument('--mark-existing-read', action='store_true',
+                            help='First mark the messages created before '
+                                 '--before as read')
+        parser.add_argument('--before',
+                            help='Cutover of --mark-existing-read, an ISO '
+                                 'date time (default: now)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options['mark_existing_read'] and not options['dry_run']:
+            before = timezone.now()
+            if options['before']:
+                before = parse_datetime(options['before'])
+                if before is None:
+                    raise CommandError('--before is not a valid date time')
+                if timezone.is_naive(before):
+                    before = timezone.make_aware(before)
+            count = mark_existing_read(before,
+                                       batch_size=options['batch_size'])
+            self.stdout.write(f'Marked {count} existing messages as read')
+
+        drift = reconcile_counters(dry_run=options['dry_run'])
+        if options['verbosity'] > 1:
+            for user_id, (stored, expected) in sorted(drift.items()):
+                self.stdout.write(f'user {user_id}: {stored} -> {expected}')
+        verb = 'Found' if options['dry_run'] else 'Repaired'
+        self.stdout.write(self.style.SUCCESS(
+            f'{verb} {len(drift)} drifted counters'))
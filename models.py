@@ -1,3 +1,6 @@
+import json
+import zlib
+
 from auditlog.registry import auditlog
 from django.conf import settings
 from django.contrib.auth import get_user_model
@@ -35,6 +38,31 @@ class ChatOpinionQuestion(AbstractFormField):
         return str(self.code)
 
 
+class QuestionnaireVersion(models.Model):
+    """
+        Immutable snapshot of all the Chat Opinion questions, labels in
+        every language included. A new version is published whenever a
+        question changes, answers keep pointing to the one they were given
+        against.
+    """
+    number = models.PositiveIntegerField(_('Version'), unique=True)
+    snapshot = models.JSONField(_('Questions'))
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Questionnaire Version')
+        verbose_name_plural = _('Questionnaire Versions')
+        ordering = ['-number']
+
+    def __str__(self):
+        return f"v{self.number}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError('Questionnaire versions can not be changed')
+        super(QuestionnaireVersion, self).save(*args, **kwargs)
+
+
 class ChatOptionAnswer(models.Model):
 
     # Target
@@ -43,6 +71,12 @@ class ChatOptionAnswer(models.Model):
                                  on_delete=models.SET_NULL, null=True)
     question_label = models.TextField(_('Question Text'), null=True,
                                       blank=True)
+    questionnaire_version = models.ForeignKey(QuestionnaireVersion,
+                                              related_name='answers',
+                                              on_delete=models.PROTECT,
+                                              null=True, blank=True)
+    question_code = models.CharField(_('Field Code'), max_length=100,
+                                     null=True, blank=True)
     # source table
     booking = models.ForeignKey('booking.booking',
                                     related_name='booking_Chat_opinion_answer',
@@ -74,6 +108,8 @@ class ChatOpinionConversation(TimeStampedModel):
 
     is_doctor_message = models.BooleanField(_('Is message Sent from Doctor'),
                                             default=False)
+    is_read = models.BooleanField(_('Is message Read by the Recipient'),
+                                  default=False)
 
     booking = models.ForeignKey('booking.booking',
                                     related_name='booking_conversation',
@@ -87,13 +123,19 @@ class ChatOpinionConversation(TimeStampedModel):
         verbose_name = _('Conversation')
         verbose_name_plural = _('Conversations')
         ordering = ['-created']
+        indexes = [
+            # latest message of a booking (inbox, dashboards)
+            models.Index(fields=['booking', '-created'],
+                         name='chat_conversation_latest'),
+            # admin date hierarchy
+            models.Index(fields=['created'], name='chat_conversation_created'),
+        ]
 
     def __str__(self):
-        try:
+        if self.patient_id and self.doctor_id:
             return f"{self.patient.get_full_name()} and " \
                    f"{self.doctor.user.get_full_name()}"
-        except:
-            return self.message
+        return self.message
 
     @property
     def patient_can_replay(self):
@@ -119,6 +161,168 @@ class ChatOpinionConversation(TimeStampedModel):
         return replies - messages.count()
 
 
+class ChatOpinionArchive(TimeStampedModel):
+    """
+        Conversation of a closed booking moved out of the hot
+        ChatOpinionConversation table, kept as zlib compressed JSON.
+    """
+    booking = models.OneToOneField('booking.booking',
+                                   related_name='Chat_opinion_archive',
+                                   on_delete=models.CASCADE)
+    message_count = models.PositiveIntegerField(_('Messages'), default=0)
+    data = models.BinaryField(_('Compressed Conversation'))
+
+    class Meta:
+        verbose_name = _('Archived Conversation')
+        verbose_name_plural = _('Archived Conversations')
+
+    def __str__(self):
+        return f"{self.booking_id} ({self.message_count})"
+
+    @property
+    def messages(self):
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+
+    @messages.setter
+    def messages(self, messages):
+        self.message_count = len(messages)
+        self.data = zlib.compress(
+            json.dumps(messages, separators=(',', ':')).encode('utf-8'))
+
+
+class AttachmentThumbnail(models.Model):
+    """
+        Small preview of a chat attachment: a downscaled copy of an image
+        or the first page of a PDF. ``source_name`` is the document file
+        it was made from, so a replaced file gets a new preview.
+    """
+    document = models.OneToOneField(Document,
+                                    related_name='chat_opinion_thumbnail',
+                                    on_delete=models.CASCADE)
+    file = models.ImageField(_('Thumbnail'),
+                             upload_to='documents/thumbnails/',
+                             width_field='width', height_field='height')
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
+    source_name = models.CharField(max_length=255)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = _('Attachment Thumbnail')
+        verbose_name_plural = _('Attachment Thumbnails')
+
+    def __str__(self):
+        return self.file.name
+
+
+class UnreadMessageCounter(models.Model):
+    """
+        Number of unread chat messages of a user, kept up to date when
+        messages are created and read (see unread.py).
+    """
+    user = models.OneToOneField(User, primary_key=True,
+                                related_name='chat_opinion_unread',
+                                on_delete=models.CASCADE)
+    count = models.PositiveIntegerField(_('Unread Messages'), default=0)
+
+    class Meta:
+        verbose_name = _('Unread Message Counter')
+        verbose_name_plural = _('Unread Message Counters')
+
+    def __str__(self):
+        return f"{self.user_id}: {self.count}"
+
+
+class InboxThread(models.Model):
+    """
+        Inbox row of an active Chat-opinion booking with its last message,
+        kept up to date by signals (see inbox.py) so a doctor's inbox page
+        is a range scan of the (doctor, last activity) index.
+    """
+    booking = models.OneToOneField('booking.booking', primary_key=True,
+                                   related_name='Chat_opinion_inbox',
+                                   on_delete=models.CASCADE)
+    doctor = models.ForeignKey('doctor.Doctor',
+                               related_name='Chat_opinion_inbox',
+                               on_delete=models.CASCADE)
+    last_activity = models.DateTimeField(_('Last Activity'))
+    last_message = models.CharField(_('Last Message'), max_length=120,
+                                    blank=True, default='')
+    last_is_doctor_message = models.BooleanField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Inbox Thread')
+        verbose_name_plural = _('Inbox Threads')
+        indexes = [
+            models.Index(fields=['doctor', '-last_activity', '-booking'],
+                         name='chat_inbox_activity'),
+        ]
+
+    def __str__(self):
+        return str(self.booking_id)
+
+
+class CaseResponseTimes(models.Model):
+    """
+        Milestones of a Chat-opinion case, filled in as they happen so the
+        response time statistics are only recorded once per case.
+    """
+    booking = models.OneToOneField('booking.booking', primary_key=True,
+                                   related_name='Chat_opinion_response_times',
+                                   on_delete=models.CASCADE)
+    doctor = models.ForeignKey('doctor.Doctor', null=True, blank=True,
+                               related_name='Chat_opinion_case_times',
+                               on_delete=models.SET_NULL)
+    accepted_at = models.DateTimeField(null=True, blank=True)
+    first_doctor_reply_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Case Response Times')
+        verbose_name_plural = _('Case Response Times')
+
+    def __str__(self):
+        return str(self.booking_id)
+
+
+class ResponseTimeStat(models.Model):
+    """
+        Daily response time distribution of a doctor for one metric, as a
+        histogram over analytics.BUCKETS with the percentiles derived from
+        it. Updated incrementally, read by the analytics API.
+    """
+    TIME_TO_ACCEPT = 'time_to_accept'
+    TIME_TO_FIRST_REPLY = 'time_to_first_reply'
+    TIME_TO_COMPLETE = 'time_to_complete'
+    METRICS = (
+        (TIME_TO_ACCEPT, _('Time to accept')),
+        (TIME_TO_FIRST_REPLY, _('Time to first doctor reply')),
+        (TIME_TO_COMPLETE, _('Time to complete')),
+    )
+
+    doctor = models.ForeignKey('doctor.Doctor',
+                               related_name='Chat_opinion_response_stats',
+                               on_delete=models.CASCADE)
+    day = models.DateField(_('Day'))
+    metric = models.CharField(_('Metric'), choices=METRICS, max_length=30)
+    count = models.PositiveIntegerField(default=0)
+    total_seconds = models.FloatField(default=0)
+    histogram = models.JSONField(default=list)
+    p50 = models.FloatField(null=True, blank=True)
+    p90 = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = _('Response Time Statistic')
+        verbose_name_plural = _('Response Time Statistics')
+        unique_together = ('doctor', 'day', 'metric')
+        indexes = [models.Index(fields=['day', 'metric'],
+                                name='chat_response_stat_day')]
+
+    def __str__(self):
+        return f"{self.doctor_id} {self.day} {self.metric}"
+
+
 class Complaint(TimeStampedModel):
     type = models.CharField(verbose_name=_('Complaint From'),
                             choices=COMPLAINT_FROM, default=PATIENT,
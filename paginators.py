@@ -0,0 +1,28 @@
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+        Paginator for very large tables: an unfiltered changelist takes the
+        row count from the PostgreSQL statistics instead of COUNT(*).
+        Small tables, filtered lists and other databases count as usual.
+    """
+    estimate_above = 100000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        query = getattr(queryset, 'query', None)
+        if query is not None and not query.where:
+            connection = connections[queryset.db]
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        'SELECT reltuples FROM pg_class WHERE relname = %s',
+                        [queryset.model._meta.db_table])
+                    row = cursor.fetchone()
+                if row and row[0] > self.estimate_above:
+                    return int(row[0])
+        return super(EstimatedCountPaginator, self).count
@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.translation import get_language
+from modeltranslation.settings import AVAILABLE_LANGUAGES
+from modeltranslation.utils import build_localized_fieldname
+
+from .cache import _reference, invalidate_references
+from .models import ChatOpinionQuestion, QuestionnaireVersion
+
+
+TRANSLATED_FIELDS = ('label', 'help_text')
+
+# version pk -> snapshot, versions never change so this is never invalidated
+_snapshots = {}
+
+
+def build_snapshot():
+    snapshot = {}
+    for question in ChatOpinionQuestion.objects.order_by('sort_order', 'pk'):
+        entry = {
+            'field_type': question.field_type,
+            'required': question.required,
+            'choices': question.choices,
+            'default_value': question.default_value,
+        }
+        for field in TRANSLATED_FIELDS:
+            entry[field] = {
+                language: getattr(question,
+                                  build_localized_fieldname(field, language),
+                                  None)
+                for language in AVAILABLE_LANGUAGES
+            }
+        snapshot[question.code] = entry
+    return snapshot
+
+
+def publish_questionnaire():
+    """
+        Publish the current questions as a new version, unless they did
+        not change since the latest one. Returns the current version.
+    """
+    snapshot = build_snapshot()
+    for attempt in range(2):
+        latest = QuestionnaireVersion.objects.order_by('-number').first()
+        if latest and latest.snapshot == snapshot:
+            return latest
+        try:
+            with transaction.atomic():
+                version = QuestionnaireVersion.objects.create(
+                    number=latest.number + 1 if latest else 1,
+                    snapshot=snapshot)
+        except IntegrityError:
+            # published concurrently, compare again with that one
+            continue
+        invalidate_references('questionnaire')
+        return version
+    return QuestionnaireVersion.objects.order_by('-number').first()
+
+
+def current_questionnaire_version(request=None):
+    return _reference(
+        request, 'questionnaire', 'current',
+        lambda: QuestionnaireVersion.objects.order_by('-number').first() or
+        publish_questionnaire()
+    )
+
+
+def get_snapshot(version_id):
+    snapshot = _snapshots.get(version_id)
+    if snapshot is None:
+        snapshot = QuestionnaireVersion.objects.filter(
+            pk=version_id).values_list('snapshot', flat=True).first() or {}
+        _snapshots[version_id] = snapshot
+    return snapshot
+
+
+def question_label(version_id, code, language=None):
+    labels = get_snapshot(version_id).get(code, {}).get('label', {})
+    language = language or get_language()
+    return labels.get(language) or labels.get(settings.LANGUAGE_CODE) or \
+        next((label for label in labels.values() if label), None)
+
+
+def answer_label(answer):
+    """
+        Label of the question as it was when the answer was given, in the
+        active language. Only answers older than the versioning fall back
+        to the copied label, then to the question itself.
+    """
+    if answer.questionnaire_version_id and answer.question_code:
+        label = question_label(answer.questionnaire_version_id,
+                               answer.question_code)
+        if label:
+            return label
+    if answer.question_label:
+        return answer.question_label
+    return answer.question.label if answer.question_id else None
@@ -0,0 +1,63 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .archive import CLOSED_STATUSES
+from .models import ChatOpinionConversation, ChatOptionAnswer
+
+
+RETENTION_DAYS = getattr(settings, 'CHAT_OPINION_RETENTION_DAYS', 365)
+
+
+def orphan_answers(days=RETENTION_DAYS):
+    # basket abandoned and never turned into a booking, or both deleted.
+    # Answers carry no date, ``days`` does not apply to them.
+    return ChatOptionAnswer.objects.filter(basket__isnull=True,
+                                           booking__isnull=True)
+
+
+def doctorless_conversations(days=RETENTION_DAYS):
+    # the doctor was deleted and the case is long closed
+    return ChatOpinionConversation.objects.filter(
+        doctor__isnull=True, booking__status__in=CLOSED_STATUSES,
+        created__lt=timezone.now() - timedelta(days=days))
+
+
+TARGETS = {
+    'orphan-answers': orphan_answers,
+    'doctorless-conversations': doctorless_conversations,
+}
+
+
+def purge(target, days=RETENTION_DAYS, batch_size=500, pause=0.5,
+          dry_run=False, max_batches=None):
+    """
+        Delete the rows of ``target`` in primary key order, one bounded
+        batch per short transaction with a pause in between, so locks are
+        never held for long. The delete checks the target again, a row
+        that stopped matching since the batch was read is kept. Yields
+        ``(rows, seconds)`` per batch.
+    """
+    queryset = TARGETS[target](days).order_by('pk')
+    model = queryset.model
+    last_pk = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        start = time.monotonic()
+        pks = list(queryset.filter(pk__gt=last_pk).values_list(
+            'pk', flat=True)[:batch_size])
+        if not pks:
+            break
+        rows = len(pks)
+        if not dry_run:
+            with transaction.atomic():
+                _, deleted = queryset.filter(pk__in=pks).delete()
+            rows = deleted.get(model._meta.label, 0)
+        last_pk = pks[-1]
+        batches += 1
+        yield rows, time.monotonic() - start
+        if pause and not dry_run:
+            time.sleep(pause)
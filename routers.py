@@ -0,0 +1,137 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# aliases of the read replicas in settings.DATABASES
+REPLICA_DATABASES = getattr(settings, 'CHAT_OPINION_REPLICA_DATABASES', ())
+# how long the reads of a user stay on the primary after a write
+STICKY_SECONDS = getattr(settings, 'CHAT_OPINION_REPLICA_STICKY_SECONDS', 10)
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_replica = ContextVar('chat_opinion_replica', default=None)
+
+
+def _sticky_key(user_id):
+    return f'chat_opinion:replica:sticky:{user_id}'
+
+
+def pin_to_primary(user_id):
+    cache.set(_sticky_key(user_id), True, STICKY_SECONDS)
+
+
+def is_pinned(user_id):
+    return bool(cache.get(_sticky_key(user_id)))
+
+
+def choose_replica(user):
+    """ Replica alias for the reads of ``user``, None for the primary. """
+    if not REPLICA_DATABASES:
+        return None
+    if user is not None and user.is_authenticated and is_pinned(user.pk):
+        return None
+    return random.choice(REPLICA_DATABASES)
+
+
+class ChatOpinionReplicaRouter(object):
+    """
+        Sends reads to a replica only while ChatOpinionReplicaMiddleware
+        has enabled it for the current request, everything else goes to
+        the default database.
+
+        DATABASE_ROUTERS = ['Chat_opinion.routers.ChatOpinionReplicaRouter']
+
+        Two local aliases are enough to try it, e.g. a ``replica`` copy of
+        the default settings with ``'TEST': {'MIRROR': 'default'}`` and
+        CHAT_OPINION_REPLICA_DATABASES = ('replica',).
+    """
+
+    def db_for_read(self, model, **hints):
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in REPLICA_DATABASES:
+            return False
+        return None
+
+
+def uses_replica(view_func):
+    """ Plain django views opt in with ``replica_reads = True``. """
+    view_class = getattr(view_func, 'view_class', None)
+    return view_class is not None and getattr(view_class, 'replica_reads',
+                                              False)
+
+
+class ReplicaReadsMixin(object):
+    """
+        rest_framework views: runs the ``replica_actions`` on a replica.
+        The decision is taken in ``initial()``, once the request is
+        authenticated, so token clients get their stickiness too.
+    """
+    replica_actions = ()
+
+    def initial(self, request, *args, **kwargs):
+        super(ReplicaReadsMixin, self).initial(request, *args, **kwargs)
+        if request.method in SAFE_METHODS and \
+                getattr(self, 'action', None) in self.replica_actions:
+            alias = choose_replica(request.user)
+            if alias is not None:
+                self._replica_token = _replica.set(alias)
+
+    def dispatch(self, request, *args, **kwargs):
+        try:
+            return super(ReplicaReadsMixin, self).dispatch(request, *args,
+                                                           **kwargs)
+        finally:
+            # the serializer data is built by now, rendering is only JSON
+            token = self.__dict__.pop('_replica_token', None)
+            if token is not None:
+                _replica.reset(token)
+
+
+class ChatOpinionReplicaMiddleware(object):
+    """
+        Runs the plain django views that opt in on a replica (see
+        ReplicaReadsMixin for the rest_framework ones), unless the user
+        wrote something in the last CHAT_OPINION_REPLICA_STICKY_SECONDS:
+        every successful unsafe request pins the user to the primary so
+        they always read their own writes. rest_framework sets the user
+        of the django request too, so token authenticated writes pin.
+
+        Must come after the authentication middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            response = self.get_response(request)
+        finally:
+            # the response is rendered by now, template queries included
+            token = getattr(request, '_chat_opinion_replica', None)
+            if token is not None:
+                _replica.reset(token)
+
+        user = getattr(request, 'user', None)
+        if request.method not in SAFE_METHODS and response.status_code < 400 \
+                and user is not None and user.is_authenticated:
+            pin_to_primary(user.pk)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method not in SAFE_METHODS or not uses_replica(view_func):
+            return None
+        alias = choose_replica(getattr(request, 'user', None))
+        if alias is not None:
+            request._chat_opinion_replica = _replica.set(alias)
+        return None
@@ -0,0 +1,146 @@
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import (
+    m2m_changed, post_delete, post_save, pre_save
+)
+from django.dispatch import Signal, receiver
+
+from booking.models import booking
+from config.models import Speciality, bookingFee
+from core.models import Service
+from doctor.models import Doctor
+from wagtail.documents.models import get_document_model
+from .analytics import doctor_replied, status_changed
+from .cache import invalidate_references, invalidate_speciality_facets
+from .inbox import booking_changed, message_added, message_removed
+from .models import (
+    AttachmentThumbnail, ChatOpinionConversation, ChatOpinionQuestion
+)
+from .questionnaires import publish_questionnaire
+from .thumbnails import schedule_thumbnails
+from .unread import decrement_unread, increment_unread, message_recipient
+
+
+User = get_user_model()
+Document = get_document_model()
+
+# sent once per batch of Chat-opinion bookings whose status was changed
+# with a queryset update (save() and its signals are bypassed).
+# kwargs: ``pks``, ``status``, ``user``
+chat_opinion_status_changed = Signal()
+
+
+@receiver(post_save, sender=Doctor)
+@receiver(post_delete, sender=Doctor)
+@receiver(post_save, sender=Speciality)
+@receiver(post_delete, sender=Speciality)
+@receiver(m2m_changed, sender=Speciality.doctor_specialities.through)
+def speciality_facets_changed(sender, **kwargs):
+    invalidate_speciality_facets()
+
+
+@receiver(post_save, sender=Speciality)
+@receiver(post_delete, sender=Speciality)
+def speciality_changed(sender, **kwargs):
+    invalidate_references('speciality')
+
+
+@receiver(post_save, sender=Service)
+@receiver(post_delete, sender=Service)
+def service_changed(sender, **kwargs):
+    invalidate_references('service')
+
+
+@receiver(post_save, sender=bookingFee)
+@receiver(post_delete, sender=bookingFee)
+def booking_fee_changed(sender, **kwargs):
+    invalidate_references('booking_fee')
+
+
+@receiver(pre_save, sender=User)
+def doctor_user_changing(sender, instance, update_fields=None, raw=False,
+                         **kwargs):
+    # only the (de)activation of a doctor changes the facets: compare with
+    # the stored flag, patients and last_login & co. are skipped
+    instance._chat_opinion_activation_changed = False
+    if raw or instance._state.adding or (
+            update_fields and 'is_active' not in update_fields):
+        return
+    stored = Doctor.objects.filter(user_id=instance.pk).values_list(
+        'user__is_active', flat=True).first()
+    instance._chat_opinion_activation_changed = \
+        stored is not None and stored != instance.is_active
+
+
+@receiver(post_save, sender=User)
+def doctor_user_changed(sender, instance, **kwargs):
+    if getattr(instance, '_chat_opinion_activation_changed', False):
+        instance._chat_opinion_activation_changed = False
+        invalidate_speciality_facets()
+
+
+@receiver(m2m_changed, sender=ChatOpinionConversation.doctor_attachments.through)
+@receiver(m2m_changed, sender=ChatOpinionConversation.patient_attachments.through)
+def conversation_attachments_added(sender, action, reverse, pk_set, **kwargs):
+    if action == 'post_add' and not reverse and pk_set:
+        schedule_thumbnails(pk_set)
+
+
+@receiver(post_save, sender=Document)
+def document_file_changed(sender, instance, created, **kwargs):
+    if not created and AttachmentThumbnail.objects.filter(
+            document=instance).exclude(source_name=instance.file.name).exists():
+        schedule_thumbnails([instance.pk])
+
+
+@receiver(post_save, sender=ChatOpinionConversation)
+def conversation_created(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and not instance.is_read:
+        recipient = message_recipient(instance)
+        if recipient:
+            increment_unread(recipient)
+
+
+@receiver(post_delete, sender=ChatOpinionConversation)
+def conversation_deleted(sender, instance, **kwargs):
+    if not instance.is_read:
+        recipient = message_recipient(instance)
+        if recipient:
+            decrement_unread(recipient)
+
+
+@receiver(post_save, sender=booking)
+def booking_inbox_changed(sender, instance, update_fields=None, raw=False,
+                          **kwargs):
+    if raw or update_fields and not {'status', 'doctor'} & set(update_fields):
+        return
+    booking_changed(instance)
+
+
+@receiver(post_save, sender=ChatOpinionConversation)
+def conversation_inbox_added(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        message_added(instance)
+
+
+@receiver(post_delete, sender=ChatOpinionConversation)
+def conversation_inbox_removed(sender, instance, **kwargs):
+    message_removed(instance)
+
+
+@receiver(post_save, sender=ChatOpinionQuestion)
+@receiver(post_delete, sender=ChatOpinionQuestion)
+def questionnaire_changed(sender, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(publish_questionnaire)
+
+
+@receiver(chat_opinion_status_changed)
+def record_status_response_times(sender, pks, status, **kwargs):
+    status_changed(pks, status)
+
+
+@receiver(post_save, sender=ChatOpinionConversation)
+def record_reply_response_time(sender, instance, created, raw=False, **kwargs):
+    if created and not raw and instance.is_doctor_message:
+        doctor_replied(instance)
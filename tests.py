@@ -1,3 +1,1012 @@
-from django.test import TestCase
+import csv
+import io
+import os
+import shutil
+import tempfile
+import tracemalloc
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connections, transaction
+from django.db.models.signals import post_save
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.test import (
+    APIClient, APIRequestFactory, force_authenticate
+)
+from rest_framework.viewsets import ViewSet
+from wagtail.documents.models import get_document_model
+
+from auditlog.models import LogEntry
+from booking.models import booking
+from config.models import Speciality, bookingFee
+from core.choices import COMPLETE, IN_PROGRESS, NEW
+from core.models import Service
+from doctor.models import Doctor
+from patient.models import Patient
+
+from .api.serializers import ChatOptionAnswerSerializers, attachments_data
+from . import analytics, questionnaires, retention, routers, throttling
+from .archive import archive_booking
+from .bulk_export import parse_watermark
+from .cache import (
+    CHAT_OPINION_SERVICE_SLUG, get_booking_fee, get_chat_opinion_service,
+    get_namespace_version, get_speciality, invalidate_references
+)
+from .downloads import content_disposition
+from .export import iter_case_zip
+from .inbox import doctor_inbox, rebuild_inbox
+from .models import (
+    ChatOpinionArchive, ChatOpinionConversation, ChatOpinionQuestion,
+    ChatOptionAnswer, Complaint, InboxThread, ResponseTimeStat,
+    UnreadMessageCounter
+)
+from .questionnaires import answer_label
+from .thumbnails import with_thumbnail
+from .transitions import (
+    can_transition, transition, transition_instance, transition_many
+)
+from .unread import (
+    mark_existing_read, mark_read, reconcile_counters, unread_count
+)
+from .views import DoctorListingView
+
+
+User = get_user_model()
+
+
+class ChatOpinionFixtures(object):
+    """ Doctors, patients and bookings shared by the test cases. """
+
+    def create_user(self, name):
+        user = User(**{User.USERNAME_FIELD: f'{name}@chat-opinion.test'})
+        if User.USERNAME_FIELD != 'email' and hasattr(user, 'email'):
+            user.email = f'{name}@chat-opinion.test'
+        user.first_name = name.title()
+        user.set_unusable_password()
+        user.save()
+        return user
+
+    def create_doctor(self, name='doctor'):
+        return Doctor.objects.create(user=self.create_user(name),
+                                     Chat_opinion=True, Chat_opinion_fees=100,
+                                     is_deleted=False)
+
+    def create_patient(self, name='patient'):
+        return Patient.objects.create(parent=self.create_user(name),
+                                      is_deleted=False)
+
+    def chat_opinion_service(self):
+        service, created = Service.objects.get_or_create(
+            slug=CHAT_OPINION_SERVICE_SLUG)
+        if created:
+            # drop a cached "no such service" of an earlier test
+            invalidate_references('service')
+        return service
+
+    def create_booking(self, doctor, patient, status=NEW):
+        return booking.objects.create(
+            user=patient.parent, patient=patient, doctor=doctor,
+            hospital=doctor.hospital, service_type=self.chat_opinion_service(),
+            status=status, fee=0, doctor_fees=doctor.Chat_opinion_fees)
+
+
+class DoctorListingKeysetTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctors = [self.create_doctor(f'doctor-{n}') for n in range(5)]
+        self.factory = RequestFactory()
+
+    def get_queryset(self, **params):
+        view = DoctorListingView(page_size=2)
+        view.setup(self.factory.get('/', params))
+        return view, view.get_queryset()
+
+    def test_without_cursor_returns_the_unpaginated_queryset(self):
+        view, queryset = self.get_queryset()
+        self.assertEqual(queryset.count(), 5)
+        self.assertIsNone(view.next_cursor)
+
+    def test_cursor_walks_every_doctor_once(self):
+        seen, after = [], 0
+        while after is not None:
+            view, doctors = self.get_queryset(after=after)
+            seen += [doctor.pk for doctor in doctors]
+            after = view.next_cursor
+            self.assertEqual(view.has_more, after is not None)
+        self.assertEqual(seen, sorted(doctor.pk for doctor in self.doctors))
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class SpecialityFacetInvalidationTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor = self.create_doctor()
+        self.version = get_namespace_version('facets')
+
+    def test_only_doctor_activation_drops_the_facets(self):
+        patient = self.create_patient().parent
+        patient.first_name = 'Renamed'
+        patient.save()
+        self.doctor.user.first_name = 'Renamed'
+        self.doctor.user.save()
+        self.assertEqual(get_namespace_version('facets'), self.version)
+
+        self.doctor.user.is_active = False
+        self.doctor.user.save()
+        self.assertEqual(get_namespace_version('facets'), self.version + 1)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CaseDetailCacheTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.chat_opinion_service()
+        self.client.force_login(self.patient.parent)
+        self.url = reverse('Chat_opinion:case_detail',
+                           kwargs={'slug': self.doctor.user.slug})
+
+    def test_step_two_needs_a_fixed_number_of_queries(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        with CaptureQueriesContext(connections['default']) as warm:
+            self.client.get(self.url)
+        # fee, service and speciality come from the cache
+        for model in (bookingFee, Service):
+            self.assertFalse([query for query in warm.captured_queries
+                              if model._meta.db_table in query['sql']],
+                             model)
+        # more questions do not add queries
+        for n in range(3):
+            ChatOpinionQuestion.objects.create(
+                code=f'question-{n}', label=f'Question {n}',
+                field_type='singleline')
+        with self.assertNumQueries(len(warm)):
+            self.client.get(self.url)
+
+    def test_saving_a_reference_reloads_it(self):
+        fee = bookingFee.get_solo()
+        self.assertEqual(get_booking_fee().amount, fee.amount)
+        fee.amount += 10
+        fee.save()
+        self.assertEqual(get_booking_fee().amount, fee.amount)
+
+        self.assertIsNone(get_speciality('cardiology'))
+        speciality = Speciality.objects.create(name='Cardiology',
+                                               slug='cardiology')
+        self.assertEqual(get_speciality('cardiology'), speciality)
+
+        service = get_chat_opinion_service()
+        version = get_namespace_version('service')
+        service.save()
+        self.assertEqual(get_namespace_version('service'), version + 1)
+
+
+class TransitionTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.instance = self.create_booking(self.doctor, self.patient)
+
+    def status_of(self, instance):
+        return booking.objects.values_list('status', flat=True).get(
+            pk=instance.pk)
+
+    def audit_entries(self, instance):
+        return LogEntry.objects.get_for_object(instance).filter(
+            action=LogEntry.Action.UPDATE, changes__contains='"status"')
+
+    def test_allowed_transitions(self):
+        self.assertTrue(can_transition(NEW, IN_PROGRESS))
+        self.assertTrue(can_transition(IN_PROGRESS, COMPLETE))
+        self.assertFalse(can_transition(NEW, COMPLETE))
+        self.assertFalse(can_transition(COMPLETE, IN_PROGRESS))
+
+    def test_accept_then_complete(self):
+        self.assertEqual(transition([self.instance.pk], IN_PROGRESS),
+                         [self.instance.pk])
+        self.assertEqual(transition([self.instance.pk], COMPLETE),
+                         [self.instance.pk])
+        self.assertEqual(self.status_of(self.instance), COMPLETE)
+        self.assertEqual(self.audit_entries(self.instance).count(), 2)
+
+    def test_repeated_transition_changes_nothing(self):
+        transition([self.instance.pk], IN_PROGRESS)
+        self.assertEqual(transition([self.instance.pk], IN_PROGRESS), [])
+        self.assertEqual(self.audit_entries(self.instance).count(), 1)
+
+    def test_disallowed_transition_keeps_the_status(self):
+        self.assertEqual(transition([self.instance.pk], COMPLETE), [])
+        self.assertEqual(self.status_of(self.instance), NEW)
+        self.assertFalse(self.audit_entries(self.instance).exists())
+
+    def test_stale_instance_does_not_overwrite_a_newer_status(self):
+        stale = booking.objects.get(pk=self.instance.pk)
+        transition([self.instance.pk], IN_PROGRESS)
+        transition([self.instance.pk], COMPLETE)
+        # the stale copy still believes the case is new
+        self.assertFalse(transition_instance(stale, IN_PROGRESS))
+        self.assertEqual(stale.status, NEW)
+        self.assertEqual(self.status_of(self.instance), COMPLETE)
+
+    def test_mixed_batch_only_moves_allowed_sources(self):
+        accepted = self.create_booking(self.doctor, self.patient,
+                                       status=IN_PROGRESS)
+        moved = transition([self.instance.pk, accepted.pk], COMPLETE)
+        self.assertEqual(moved, [accepted.pk])
+        self.assertEqual(self.status_of(self.instance), NEW)
+
+
+class BulkTransitionTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        doctor, patient = self.create_doctor(), self.create_patient()
+        self.new = [self.create_booking(doctor, patient) for n in range(3)]
+        self.closed = self.create_booking(doctor, patient, status=COMPLETE)
+        self.saved = []
+        post_save.connect(self.on_save, sender=booking)
+        self.addCleanup(post_save.disconnect, self.on_save, sender=booking)
+
+    def on_save(self, sender, instance, created, update_fields, **kwargs):
+        self.saved.append((instance.pk, instance.status, update_fields))
+
+    def test_post_save_is_sent_for_every_moved_booking(self):
+        pks = [instance.pk for instance in self.new] + [self.closed.pk]
+        moved = transition_many(pks, IN_PROGRESS)
+        self.assertCountEqual(moved, [instance.pk for instance in self.new])
+        self.assertCountEqual([pk for pk, status, fields in self.saved], moved)
+        for pk, status, fields in self.saved:
+            self.assertEqual(status, IN_PROGRESS)
+            self.assertIn('status', fields)
+
+    def test_nothing_is_sent_when_nothing_moved(self):
+        self.assertEqual(transition_many([self.closed.pk], IN_PROGRESS), [])
+        self.assertEqual(self.saved, [])
+
+
+class BulkCaseActionTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, patient = self.create_doctor(), self.create_patient()
+        self.bookings = [self.create_booking(self.doctor, patient)
+                         for n in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.doctor.user)
+        self.url = reverse('chatting_api:chat-opinion-bulk')
+
+    def statuses(self):
+        return set(booking.objects.filter(
+            pk__in=[instance.pk for instance in self.bookings]
+        ).values_list('status', flat=True))
+
+    def test_accepts_a_list_of_ids(self):
+        ids = [instance.pk for instance in self.bookings]
+        response = self.client.post(self.url, {'action': 'accept', 'ids': ids},
+                                    format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data['results'].values()), {'updated'})
+        self.assertEqual(self.statuses(), {IN_PROGRESS})
+
+    def test_form_bodies_keep_every_id(self):
+        ids = [instance.pk for instance in self.bookings]
+        response = self.client.post(self.url, {'action': 'accept', 'ids': ids})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(response.data['results']),
+                         sorted(str(pk) for pk in ids))
+
+    def test_malformed_bodies_are_rejected(self):
+        ids = ''.join(str(instance.pk) for instance in self.bookings[:2])
+        for data in ({'action': 'accept', 'ids': ids},
+                     {'action': 'accept', 'ids': []},
+                     {'action': 'accept', 'ids': ['x']},
+                     {'action': 'delete', 'ids': [self.bookings[0].pk]},
+                     [self.bookings[0].pk]):
+            response = self.client.post(self.url, data, format='json')
+            self.assertEqual(response.status_code, 400, data)
+        self.assertEqual(self.statuses(), {NEW})
+
+
+class ArchiveTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.instance = self.create_booking(self.doctor, self.patient,
+                                            status=COMPLETE)
+        now = timezone.now()
+        self.messages = [self.message(f'message {n}',
+                                      now - timedelta(hours=10 - n))
+                         for n in range(3)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.patient.parent)
+
+    def message(self, text, created):
+        message = ChatOpinionConversation.objects.create(
+            booking=self.instance, patient=self.patient, doctor=self.doctor,
+            message=text)
+        ChatOpinionConversation.objects.filter(pk=message.pk).update(
+            created=created)
+        return message
+
+    def thread(self):
+        response = self.client.get(reverse('chatting_api:chat-list'),
+                                   {'booking': self.instance.pk})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def archived_ids(self):
+        archive = ChatOpinionArchive.objects.get(booking=self.instance)
+        self.assertEqual(archive.message_count, len(archive.messages))
+        return [message['id'] for message in archive.messages]
+
+    def test_archived_thread_is_read_back_in_the_same_shape(self):
+        hot = self.thread()
+        self.assertEqual(archive_booking(self.instance.pk), 3)
+        self.assertFalse(ChatOpinionConversation.objects.filter(
+            booking=self.instance).exists())
+        self.assertEqual(self.archived_ids(),
+                         [message.pk for message in reversed(self.messages)])
+
+        archived = self.thread()
+        self.assertEqual([set(message) for message in archived],
+                         [set(message) for message in hot])
+        self.assertEqual(
+            [(message['id'], message['message']) for message in archived],
+            [(message['id'], message['message']) for message in hot])
+
+    def test_archiving_again_merges_by_date(self):
+        archive_booking(self.instance.pk)
+        now = timezone.now()
+        # one committed late with an older date, one really newer
+        late = self.message('late', now - timedelta(hours=8, minutes=30))
+        newer = self.message('newer', now)
+        self.assertEqual(archive_booking(self.instance.pk), 2)
+        first, second, third = self.messages
+        self.assertEqual(self.archived_ids(),
+                         [newer.pk, third.pk, late.pk, second.pk, first.pk])
+        self.assertEqual(archive_booking(self.instance.pk), 0)
+
+
+class CaseExportTests(ChatOpinionFixtures, TestCase):
+    attachment_size = 300 * 1024 * 1024
+    memory_ceiling = 4 * 1024 * 1024
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings = override_settings(MEDIA_ROOT=self.media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        # sparse file: large on disk without taking the time to write it
+        os.makedirs(os.path.join(self.media_root, 'documents'))
+        with open(os.path.join(self.media_root, 'documents', 'scan.bin'),
+                  'wb') as scan:
+            scan.seek(self.attachment_size - 1)
+            scan.write(b'\0')
+        document = get_document_model()(title='Scan')
+        document.file.name = 'documents/scan.bin'
+        document.save()
+
+        self.instance = self.create_booking(self.create_doctor(),
+                                            self.create_patient())
+        self.instance.attachments.add(document)
+
+    def test_large_case_is_streamed_in_constant_memory(self):
+        output = tempfile.TemporaryFile()
+        self.addCleanup(output.close)
+        tracemalloc.start()
+        try:
+            for chunk in iter_case_zip(self.instance):
+                output.write(chunk)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(peak, self.memory_ceiling)
+
+        output.seek(0)
+        with zipfile.ZipFile(output) as archive:
+            self.assertEqual(archive.namelist(), [
+                'answers.txt', 'transcript.txt', 'attachments/case/scan.bin'])
+            info = archive.getinfo('attachments/case/scan.bin')
+            self.assertEqual(info.file_size, self.attachment_size)
+            with archive.open(info) as scan:
+                self.assertEqual(scan.read(16), b'\0' * 16)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ThumbnailUrlTests(TestCase):
+
+    def test_documents_without_preview_are_only_queried_once(self):
+        document = get_document_model().objects.create(
+            title='Notes', file='documents/notes.txt')
+        with self.assertNumQueries(1):
+            self.assertEqual(with_thumbnail([document]), set())
+        with self.assertNumQueries(0):
+            self.assertEqual(with_thumbnail([document]), set())
+
+
+class AttachmentDownloadTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(MEDIA_ROOT=media_root)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.patient = self.create_patient()
+        self.instance = self.create_booking(self.create_doctor(), self.patient)
+        self.document = get_document_model()(title='Report')
+        self.document.file.save('report.txt', ContentFile(b'medical report'))
+        self.instance.attachments.add(self.document)
+        self.url = reverse('chatting_api:chat-opinion-attachment', kwargs={
+            'pk': self.instance.pk, 'document_pk': self.document.pk})
+
+    def get(self, user, **headers):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.get(self.url, **headers)
+
+    def test_serializers_link_the_protected_url(self):
+        request = APIRequestFactory().get('/')
+        data = attachments_data([self.document], self.instance.pk,
+                                context={'request': request})
+        self.assertEqual(data[0]['attachment'],
+                         request.build_absolute_uri(self.url))
+        self.assertNotIn('/documents/', data[0]['attachment'])
+
+    def test_participant_downloads_the_attachment(self):
+        response = self.get(self.patient.parent)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'medical report')
+
+    def test_other_users_get_a_404(self):
+        response = self.get(self.create_user('stranger'))
+        self.assertEqual(response.status_code, 404)
+
+    def test_ranges(self):
+        response = self.get(self.patient.parent, HTTP_RANGE='bytes=8-13')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), b'report')
+        self.assertEqual(response['Content-Range'], 'bytes 8-13/14')
+        response = self.get(self.patient.parent, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        # several ranges are not supported: the whole file is sent
+        response = self.get(self.patient.parent, HTTP_RANGE='bytes=0-0,5-6')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'medical report')
+
+    def test_file_names_are_escaped_and_encoded(self):
+        self.assertEqual(
+            content_disposition('ré"port.pdf'),
+            'attachment; filename="re\\"port.pdf"; '
+            "filename*=UTF-8''r%C3%A9%22port.pdf")
+        self.assertTrue(content_disposition('отчёт.pdf', False).startswith(
+            'inline; filename=".pdf"; filename*=UTF-8\'\'%D0%BE'))
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ThrottleTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        rates = mock.patch.dict(throttling.THROTTLE_RATES, {
+            'chat_message_user': (100, 60),
+            'chat_message_booking': (2, 60),
+            'chat_upload_bytes': (10 * 1024 * 1024, 60),
+        })
+        rates.start()
+        self.addCleanup(rates.stop)
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.instance = self.create_booking(self.doctor, self.patient,
+                                            status=IN_PROGRESS)
+        self.url = reverse('chatting_api:chat-list')
+
+    def post(self, user, **data):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(self.url, data, format='json')
+
+    def test_window_fills_and_slides(self):
+        with mock.patch.object(throttling, 'time') as clock:
+            clock.time.return_value = 1000.0
+            self.assertEqual(throttling.consume('chat_message_booking', 1), 0)
+            self.assertEqual(throttling.consume('chat_message_booking', 1), 0)
+            self.assertAlmostEqual(
+                throttling.consume('chat_message_booking', 1), 50)
+            clock.time.return_value = 1049.0
+            self.assertTrue(throttling.consume('chat_message_booking', 1))
+            clock.time.return_value = 1050.0
+            self.assertEqual(throttling.consume('chat_message_booking', 1), 0)
+
+    def test_parallel_requests_cannot_share_a_token(self):
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            waits = list(executor.map(
+                lambda n: throttling.consume('chat_message_booking', 1),
+                range(16)))
+        self.assertEqual(waits.count(0), 2)
+
+    @override_settings(CHAT_OPINION_THROTTLE_ENABLED=False)
+    def test_throttles_can_be_switched_off(self):
+        for n in range(5):
+            self.assertEqual(throttling.consume('chat_message_booking', 1), 0)
+
+    def test_booking_in_the_body_is_limited(self):
+        for n in range(2):
+            self.assertNotEqual(self.post(self.patient.parent,
+                                          booking=self.instance.pk,
+                                          message='hi').status_code, 429)
+        response = self.post(self.patient.parent, booking=self.instance.pk,
+                             message='hi')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response)
+        # the doctor of the booking has a bucket of their own
+        self.assertNotEqual(self.post(self.doctor.user,
+                                      booking=self.instance.pk,
+                                      message='hi').status_code, 429)
+
+    def test_strangers_cannot_lock_the_participants_out(self):
+        stranger = self.create_user('stranger')
+        for n in range(5):
+            self.post(stranger, booking=self.instance.pk, message='junk')
+        self.assertEqual(self.post(stranger, booking=self.instance.pk,
+                                   message='junk').status_code, 429)
+        response = self.post(self.patient.parent, booking=self.instance.pk,
+                             message='hi')
+        self.assertNotEqual(response.status_code, 429)
+
+    def test_leaving_the_booking_out_does_not_skip_the_limit(self):
+        user = self.create_user('sender')
+        for n in range(2):
+            self.assertNotEqual(self.post(user, message='hi').status_code, 429)
+        self.assertEqual(self.post(user, message='hi').status_code, 429)
+
+
+class UnreadCounterTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.instance = self.create_booking(self.doctor, self.patient,
+                                            status=IN_PROGRESS)
+
+    def message(self, is_doctor_message, **kwargs):
+        return ChatOpinionConversation.objects.create(
+            booking=self.instance, patient=self.patient, doctor=self.doctor,
+            is_doctor_message=is_doctor_message, message='hello', **kwargs)
+
+    def test_messages_count_for_their_recipient(self):
+        self.message(False)
+        self.message(False)
+        self.message(True)
+        self.assertEqual(unread_count(self.doctor.user), 2)
+        self.assertEqual(unread_count(self.patient.parent), 1)
+
+    def test_reading_and_deleting_take_messages_off(self):
+        first, second = self.message(False), self.message(False)
+        thread = ChatOpinionConversation.objects.filter(booking=self.instance)
+        self.assertEqual(mark_read(thread.filter(pk=first.pk),
+                                   self.doctor.user), 1)
+        self.assertEqual(unread_count(self.doctor.user), 1)
+        second.delete()
+        self.assertEqual(unread_count(self.doctor.user), 0)
+        # reading twice does not go below zero
+        self.assertEqual(mark_read(thread, self.doctor.user), 0)
+        self.assertEqual(unread_count(self.doctor.user), 0)
+
+    def test_reconcile_repairs_drift(self):
+        self.message(False)
+        UnreadMessageCounter.objects.filter(user=self.doctor.user).update(
+            count=7)
+        self.assertEqual(reconcile_counters(),
+                         {self.doctor.user.pk: (7, 1)})
+        self.assertEqual(unread_count(self.doctor.user), 1)
+        self.assertEqual(reconcile_counters(), {})
+
+    def test_existing_messages_are_backfilled_before_reconciling(self):
+        old = [self.message(False) for n in range(3)]
+        cutover = timezone.now()
+        self.message(False)
+        UnreadMessageCounter.objects.all().delete()
+        self.assertEqual(mark_existing_read(cutover, batch_size=2), len(old))
+        reconcile_counters()
+        self.assertEqual(unread_count(self.doctor.user), 1)
+
+
+class DoctorInboxTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.bookings = [self.create_booking(self.doctor, self.patient)
+                         for n in range(5)]
+        for instance in self.bookings:
+            self.message(instance, f'about {instance.pk}')
+
+    def message(self, instance, text):
+        return ChatOpinionConversation.objects.create(
+            booking=instance, patient=self.patient, doctor=self.doctor,
+            message=text)
+
+    def inbox(self, limit=2):
+        threads, cursor, pages = [], None, 0
+        while True:
+            page, cursor = doctor_inbox(self.doctor.user, cursor=cursor,
+                                        limit=limit)
+            threads += page
+            pages += 1
+            if cursor is None:
+                return threads, pages
+
+    def test_pages_walk_threads_by_last_activity(self):
+        threads, pages = self.inbox()
+        self.assertEqual(pages, 3)
+        self.assertEqual([thread.booking_id for thread in threads],
+                         [instance.pk for instance in reversed(self.bookings)])
+        self.assertEqual(threads[0].last_message,
+                         f'about {self.bookings[-1].pk}')
+
+    def test_new_message_moves_the_thread_up(self):
+        self.message(self.bookings[0], 'follow up')
+        threads, pages = self.inbox()
+        self.assertEqual(threads[0].booking_id, self.bookings[0].pk)
+        self.assertEqual(threads[0].last_message, 'follow up')
+
+    def test_closed_bookings_and_other_doctors_are_left_out(self):
+        transition_instance(self.bookings[0], IN_PROGRESS)
+        transition_instance(self.bookings[0], COMPLETE)
+        self.create_booking(self.create_doctor('other'), self.patient)
+        threads, pages = self.inbox(limit=10)
+        self.assertEqual(len(threads), 4)
+        self.assertNotIn(self.bookings[0].pk,
+                         [thread.booking_id for thread in threads])
+
+    def test_rebuild_matches_the_signals(self):
+        self.message(self.bookings[2], 'latest')
+        fields = ('booking_id', 'doctor_id', 'last_activity', 'last_message',
+                  'last_is_doctor_message', 'last_message_at')
+        kept = list(InboxThread.objects.order_by('pk').values_list(*fields))
+        self.assertEqual(rebuild_inbox(), 5)
+        self.assertEqual(
+            list(InboxThread.objects.order_by('pk').values_list(*fields)),
+            kept)
+
+
+class ReplicaProbe(routers.ReplicaReadsMixin, ViewSet):
+    """ Reports the database its reads are routed to. """
+    replica_actions = ('list',)
+
+    def list(self, request):
+        return Response({'database': routers.ChatOpinionReplicaRouter(
+        ).db_for_read(booking)})
+
+    def create(self, request):
+        return Response({'database': routers.ChatOpinionReplicaRouter(
+        ).db_for_read(booking)}, status=201)
+
+
+@override_settings(CACHES={'default': {
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class ReplicaRoutingTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        replicas = mock.patch.object(routers, 'REPLICA_DATABASES', ('replica',))
+        replicas.start()
+        self.addCleanup(replicas.stop)
+        self.user = self.create_user('reader')
+        self.factory = APIRequestFactory()
+        view = ReplicaProbe.as_view({'get': 'list', 'post': 'create'})
+        # token clients: the user is only known to rest_framework
+        self.middleware = routers.ChatOpinionReplicaMiddleware(view)
+
+    def request(self, method):
+        request = getattr(self.factory, method)('/')
+        force_authenticate(request, self.user)
+        response = self.middleware(request)
+        response.render()
+        return response
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(self.request('get').data['database'], 'replica')
+        # and the routing ends with the request
+        self.assertIsNone(routers.ChatOpinionReplicaRouter().db_for_read(
+            booking))
+
+    def test_writes_stay_on_the_primary(self):
+        self.assertIsNone(self.request('post').data['database'])
+
+    def test_reads_after_a_write_stick_to_the_primary(self):
+        self.request('post')
+        self.assertTrue(routers.is_pinned(self.user.pk))
+        self.assertIsNone(self.request('get').data['database'])
+
+    def test_other_users_are_not_pinned(self):
+        self.request('post')
+        self.user = self.create_user('other-reader')
+        self.assertEqual(self.request('get').data['database'], 'replica')
+
+
+@skipUnless('replica' in settings.DATABASES,
+            "needs a 'replica' alias, e.g. with TEST MIRROR 'default'")
+@override_settings(
+    CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    DATABASE_ROUTERS=['Chat_opinion.routers.ChatOpinionReplicaRouter'])
+class ReplicaAliasTests(ChatOpinionFixtures, TestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        replicas = mock.patch.object(routers, 'REPLICA_DATABASES', ('replica',))
+        replicas.start()
+        self.addCleanup(replicas.stop)
+        self.patient = self.create_patient()
+        self.client = APIClient()
+        self.client.force_authenticate(self.patient.parent)
+
+    def replica_queries(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connections['replica']) as queries:
+            getattr(self.client, method)(*args, **kwargs)
+        return len(queries)
+
+    def test_case_list_reads_the_replica_until_the_user_writes(self):
+        url = reverse('chatting_api:chat-opinion-list')
+        self.assertGreater(self.replica_queries('get', url), 0)
+        routers.pin_to_primary(self.patient.parent.pk)
+        self.assertEqual(self.replica_queries('get', url), 0)
+
+
+class IncrementalExportTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.state = os.path.join(directory, 'state.json')
+        self.output = os.path.join(directory, 'complaints.csv')
+        self.instance = self.create_booking(self.create_doctor(),
+                                            self.create_patient())
+
+    def complaint(self, modified=None):
+        complaint = Complaint.objects.create(booking=self.instance,
+                                             description='late answer')
+        if modified is not None:
+            Complaint.objects.filter(pk=complaint.pk).update(modified=modified)
+        return complaint
+
+    def export(self):
+        call_command('export_chat_opinion_data', 'complaints',
+                     state_file=self.state, output=self.output,
+                     stderr=io.StringIO())
+        with open(self.output, newline='') as output:
+            return [int(row['id']) for row in csv.DictReader(output)]
+
+    def test_every_row_is_exported_once(self):
+        first = [self.complaint() for n in range(3)]
+        self.assertEqual(self.export(), [complaint.pk for complaint in first])
+        self.assertEqual(self.export(), [])
+
+        # same modified as the watermark, and committed late with an
+        # earlier one: both were skipped by a plain "modified > since"
+        watermark = Complaint.objects.get(pk=first[-1].pk).modified
+        tie = self.complaint(modified=watermark)
+        late = self.complaint(modified=watermark - timedelta(minutes=1))
+        self.assertCountEqual(self.export(), [tie.pk, late.pk])
+        self.assertEqual(self.export(), [])
+
+    def test_updated_rows_are_exported_again(self):
+        complaint = self.complaint()
+        self.export()
+        complaint.description = 'edited'
+        complaint.save()
+        self.assertEqual(self.export(), [complaint.pk])
+
+    def test_invalid_watermarks_are_rejected(self):
+        for since in ('2021-02-30T00:00:00', 'yesterday'):
+            with self.assertRaises(CommandError):
+                call_command('export_chat_opinion_data', 'complaints',
+                             since=since, output=self.output)
+        staff = self.create_user('staff')
+        staff.is_staff = True
+        staff.save()
+        client = APIClient()
+        client.force_authenticate(staff)
+        url = reverse('chatting_api:chat-opinion-data-export',
+                      kwargs={'dataset': 'complaints'})
+        response = client.get(url, {'since': '2021-02-30T00:00:00'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_naive_watermarks_are_made_aware(self):
+        since = parse_watermark('complaints', '2021-02-23T00:00:00')
+        self.assertTrue(timezone.is_aware(since))
+        self.assertEqual(parse_watermark('answers', '1500'), 1500)
+
+
+class AdminSearchTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        admin = self.create_user('admin')
+        admin.is_staff = admin.is_superuser = True
+        admin.save()
+        self.client.force_login(admin)
+        self.instance = self.create_booking(self.create_doctor(),
+                                            self.create_patient())
+        self.answer = ChatOptionAnswer.objects.create(booking=self.instance,
+                                                      answer='since monday')
+
+    def search(self, model, term):
+        url = reverse(f'admin:{model._meta.app_label}_'
+                      f'{model._meta.model_name}_changelist')
+        return self.client.get(url, {'q': term})
+
+    def test_text_terms_do_not_break_the_id_search(self):
+        for model in (ChatOptionAnswer, ChatOpinionConversation):
+            response = self.search(model, 'john')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context['cl'].result_list), 0)
+
+    def test_booking_id_search(self):
+        response = self.search(ChatOptionAnswer, str(self.instance.pk))
+        self.assertEqual(list(response.context['cl'].result_list),
+                         [self.answer])
+
+
+class QuestionnaireVersionTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        # versions are cached per process and by primary key
+        questionnaires._snapshots.clear()
+        self.addCleanup(questionnaires._snapshots.clear)
+        invalidate_references('questionnaire')
+        self.question = ChatOpinionQuestion.objects.create(
+            code='symptoms', label='Symptoms', field_type='singleline')
+        self.version = questionnaires.publish_questionnaire()
+
+    def answer(self, **kwargs):
+        return ChatOptionAnswer.objects.create(
+            question=self.question, question_code=self.question.code,
+            answer='headache', **kwargs)
+
+    def test_editing_a_question_does_not_rewrite_history(self):
+        answer = self.answer(questionnaire_version=self.version)
+        self.question.label = 'Main symptoms'
+        self.question.save()
+        version = questionnaires.publish_questionnaire()
+        self.assertEqual(version.number, self.version.number + 1)
+        self.assertEqual(answer_label(answer), 'Symptoms')
+        new = self.answer(questionnaire_version=version)
+        self.assertEqual(answer_label(new), 'Main symptoms')
+        # publishing again without a change keeps the version
+        self.assertEqual(questionnaires.publish_questionnaire(), version)
+
+    def test_answers_render_without_a_query_per_row(self):
+        answers = [self.answer(questionnaire_version=self.version)
+                   for n in range(5)]
+        questionnaires._snapshots.clear()
+        with self.assertNumQueries(1):
+            data = ChatOptionAnswerSerializers(answers, many=True).data
+        self.assertEqual({item['question_label'] for item in data},
+                         {'Symptoms'})
+
+    def test_answers_without_a_version_use_the_copied_label(self):
+        answer = self.answer(question_label='Symptoms (2020)')
+        self.question.label = 'Main symptoms'
+        self.question.save()
+        self.assertEqual(answer_label(answer), 'Symptoms (2020)')
+
+
+class PurgeTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.instance = self.create_booking(self.create_doctor(),
+                                            self.create_patient())
+        self.orphans = [ChatOptionAnswer.objects.create(answer='orphan')
+                        for n in range(3)]
+        self.kept = ChatOptionAnswer.objects.create(booking=self.instance,
+                                                    answer='kept')
+
+    def purge(self, **kwargs):
+        return sum(rows for rows, seconds in retention.purge(
+            'orphan-answers', batch_size=2, pause=0, **kwargs))
+
+    def test_orphans_are_deleted_in_batches(self):
+        self.assertEqual(self.purge(dry_run=True), 3)
+        self.assertEqual(self.purge(), 3)
+        self.assertEqual(list(ChatOptionAnswer.objects.all()), [self.kept])
+
+    def test_rows_matching_no_more_at_delete_time_are_kept(self):
+        relinked = self.orphans[0]
+        atomic = transaction.atomic
+
+        def relink_first(*args, **kwargs):
+            # the answer is linked again between the scan and the delete
+            ChatOptionAnswer.objects.filter(pk=relinked.pk).update(
+                booking=self.instance)
+            return atomic(*args, **kwargs)
+
+        with mock.patch.object(retention.transaction, 'atomic',
+                               relink_first):
+            self.assertEqual(self.purge(), 2)
+        self.assertTrue(ChatOptionAnswer.objects.filter(
+            pk=relinked.pk).exists())
+
+
+class ResponseTimeTests(ChatOpinionFixtures, TestCase):
+
+    def setUp(self):
+        self.doctor, self.patient = self.create_doctor(), self.create_patient()
+        self.instance = self.create_booking(self.doctor, self.patient)
+
+    def histogram(self, **counts):
+        # bucket index -> count
+        histogram = [0] * (len(analytics.BUCKETS) + 1)
+        for index, count in counts.items():
+            histogram[int(index[1:])] = count
+        return histogram
+
+    def test_repeated_accept_records_one_sample(self):
+        analytics.status_changed([self.instance.pk], IN_PROGRESS)
+        analytics.status_changed([self.instance.pk], IN_PROGRESS)
+        stat = ResponseTimeStat.objects.get(
+            doctor=self.doctor, metric=ResponseTimeStat.TIME_TO_ACCEPT)
+        self.assertEqual(stat.count, 1)
+        self.assertEqual(sum(stat.histogram), 1)
+
+    def test_percentiles_interpolate_inside_the_bucket(self):
+        # 4 samples under a minute, 6 between one and five minutes
+        histogram = self.histogram(b0=4, b1=6)
+        self.assertAlmostEqual(analytics.histogram_percentile(histogram, 50),
+                               100)
+        self.assertAlmostEqual(analytics.histogram_percentile(histogram, 90),
+                               260)
+        self.assertIsNone(analytics.histogram_percentile(self.histogram(), 50))
+        overflow = self.histogram(**{f'b{len(analytics.BUCKETS)}': 3})
+        self.assertEqual(analytics.histogram_percentile(overflow, 90),
+                         analytics.BUCKETS[-1])
+
+    def test_doctors_are_merged_unless_asked_by_doctor(self):
+        other = self.create_doctor('other-doctor')
+        day = timezone.localdate()
+        rows = ((self.doctor, self.histogram(b0=4), 120),
+                (other, self.histogram(b1=6), 1080))
+        for doctor, histogram, total in rows:
+            ResponseTimeStat.objects.create(
+                doctor=doctor, day=day, metric=ResponseTimeStat.TIME_TO_ACCEPT,
+                count=sum(histogram), total_seconds=total, histogram=histogram)
+
+        merged, = analytics.response_time_report(since=day, until=day)
+        self.assertEqual(merged['count'], 10)
+        self.assertAlmostEqual(merged['mean'], 120)
+        self.assertAlmostEqual(merged['p50'], 100)
+        self.assertNotIn('doctor', merged)
+
+        by_doctor = analytics.response_time_report(since=day, until=day,
+                                                   by_doctor=True)
+        self.assertEqual({row['doctor']: row['count'] for row in by_doctor},
+                         {self.doctor.pk: 4, other.pk: 6})
+        self.assertAlmostEqual(
+            next(row['p50'] for row in by_doctor
+                 if row['doctor'] == self.doctor.pk), 30)
+
+    def test_invalid_dates_are_rejected(self):
+        staff = self.create_user('staff')
+        staff.is_staff = True
+        staff.save()
+        client = APIClient()
+        client.force_authenticate(staff)
+        url = reverse('chatting_api:chat-opinion-analytics')
+        for since in ('2021-02-30', 'yesterday'):
+            self.assertEqual(client.get(url, {'since': since}).status_code,
+                             400)
+        self.assertEqual(client.get(url, {'since': '2021-02-01'}).status_code,
+                         200)
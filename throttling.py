@@ -0,0 +1,159 @@
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import JsonResponse
+from django.utils.translation import gettext_lazy as _
+from rest_framework.throttling import BaseThrottle
+
+from .instrumentation import increment
+
+
+# scope -> (bucket size, seconds to refill an empty bucket)
+THROTTLE_RATES = {
+    'chat_message_user': (30, 60),
+    'chat_message_booking': (20, 60),
+    'chat_upload_bytes': (25 * 1024 * 1024, 60),
+}
+THROTTLE_RATES.update(getattr(settings, 'CHAT_OPINION_THROTTLE_RATES', {}))
+
+
+def throttles_enabled():
+    # read per call so tests and the benchmark can use override_settings
+    return getattr(settings, 'CHAT_OPINION_THROTTLE_ENABLED', True)
+
+
+def _spend(key, cost, timeout):
+    """ Add ``cost`` to the counter at ``key`` atomically, return the total. """
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key, cost)
+    except ValueError:
+        # expired between add and incr
+        cache.add(key, 0, timeout)
+        return cache.incr(key, cost)
+
+
+def consume(scope, ident, cost=1):
+    """
+        Take ``cost`` tokens from the ``scope`` bucket of ``ident``.
+        Returns 0 when allowed, otherwise the seconds until enough tokens
+        are back.
+
+        The bucket is approximated by a sliding window: a counter per
+        period, with the previous one weighted by the part of it still
+        inside the window. Counters are only changed with ``cache.incr``
+        and ``cache.decr``, which are atomic on the shared cache, so
+        parallel requests of a client cannot all read the same free token.
+    """
+    if not throttles_enabled():
+        return 0
+    capacity, period = THROTTLE_RATES[scope]
+    # a request bigger than the bucket may still pass on an empty window
+    cost = min(cost, capacity)
+    now = time.time()
+    window, elapsed = divmod(now, period)
+    key = f'chat_opinion:throttle:{scope}:{ident}'
+    previous = cache.get(f'{key}:{int(window) - 1}', 0)
+    current = _spend(f'{key}:{int(window)}', cost, period * 2)
+    remaining = 1 - elapsed / period
+    if previous * remaining + current <= capacity:
+        return 0
+
+    # refused requests do not use tokens
+    cache.decr(f'{key}:{int(window)}', cost)
+    increment('chat_opinion_throttled_total', scope)
+    if current <= capacity:
+        # wait until enough of the previous period left the window
+        return (remaining - (capacity - current) / previous) * period
+    # this period alone is full: wait into the next one
+    spent = current - cost
+    return (remaining + max(0, 1 - (capacity - cost) / spent)) * period
+
+
+def _content_length(request):
+    try:
+        return int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return 0
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+        rest_framework throttle on a token bucket. The base throttles only
+        look at the user and the Content-Length header, so they refuse a
+        request before its body is parsed; subclasses reading the body
+        (ChatMessageBookingThrottle) go last.
+    """
+    scope = None
+
+    def get_ident(self, request, view):
+        return request.user.pk if request.user.is_authenticated else None
+
+    def get_cost(self, request):
+        return 1
+
+    def allow_request(self, request, view):
+        ident = self.get_ident(request, view)
+        if ident is None:
+            self.wait_seconds = 0
+            return True
+        self.wait_seconds = consume(self.scope, ident, self.get_cost(request))
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
+
+
+class ChatMessageUserThrottle(TokenBucketThrottle):
+    scope = 'chat_message_user'
+
+
+class ChatMessageBookingThrottle(TokenBucketThrottle):
+    """
+        Per booking bucket, on the ``booking`` of the parsed body: the one
+        the message is saved to. The base64 ``files`` are only decoded later
+        by the serializer. The bucket belongs to the poster and the booking
+        together: it is charged before the serializer checks that the user
+        takes part in the booking, so posts naming someone else's booking
+        must not empty the bucket of its doctor and patient. Posts without
+        a valid booking are charged to a bucket of their own, so leaving it
+        out does not skip the limit.
+    """
+    scope = 'chat_message_booking'
+
+    def get_ident(self, request, view):
+        if not request.user.is_authenticated:
+            return None
+        data = request.data
+        booking = str(data.get('booking', '')) if hasattr(data, 'get') else ''
+        return f"{request.user.pk}:{booking if booking.isdigit() else '-'}"
+
+
+class ChatUploadThrottle(TokenBucketThrottle):
+    scope = 'chat_upload_bytes'
+
+    def get_cost(self, request):
+        return _content_length(request)
+
+
+class ThrottledPostMixin(object):
+    """ Token bucket throttling for the POST of plain django views. """
+    throttle_scopes = ('chat_message_user', 'chat_upload_bytes')
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method == 'POST' and request.user.is_authenticated:
+            wait = 0
+            for scope in self.throttle_scopes:
+                cost = _content_length(request) \
+                    if scope == 'chat_upload_bytes' else 1
+                wait = max(wait, consume(scope, request.user.pk, cost))
+            if wait:
+                response = JsonResponse(
+                    {'error_message': _('Too many requests, please retry later')},
+                    status=429)
+                response['Retry-After'] = str(math.ceil(wait))
+                return response
+        return super(ThrottledPostMixin, self).dispatch(request, *args,
+                                                        **kwargs)
@@ -0,0 +1,155 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from django.utils.module_loading import import_string
+from PIL import Image
+from wagtail.documents.models import get_document_model
+
+from .models import AttachmentThumbnail
+
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = getattr(settings, 'CHAT_OPINION_THUMBNAIL_SIZE', (320, 320))
+# set to False to generate previews inline, e.g. in tests
+THUMBNAILS_ASYNC = getattr(settings, 'CHAT_OPINION_THUMBNAILS_ASYNC', True)
+# dotted path of a callable taking a list of document ids, e.g. the
+# ``delay`` of a task queue job calling ``generate_thumbnails``
+THUMBNAILS_TASK = getattr(settings, 'CHAT_OPINION_THUMBNAILS_TASK', None)
+CACHE_TIMEOUT = 60 * 60 * 24
+# cached for documents without a preview so a miss is not queried on every
+# render, short lived since the preview may still be on its way
+NO_THUMBNAIL = '__none__'
+NO_THUMBNAIL_TIMEOUT = 60 * 10
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp',
+                    '.tif', '.tiff')
+
+_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def _cache_key(document_id):
+    return f'chat_opinion:thumbnail:{document_id}'
+
+
+def _render_image(source):
+    image = Image.open(source)
+    # JPEG scans are decoded at a reduced scale instead of full size
+    image.draft('RGB', THUMBNAIL_SIZE)
+    image.thumbnail(THUMBNAIL_SIZE)
+    return image
+
+
+def _render_pdf(source):
+    # PyMuPDF is optional, PDFs simply get no preview without it
+    try:
+        import fitz
+    except ImportError:
+        return None
+    with fitz.open(stream=source.read(), filetype='pdf') as pdf:
+        if not pdf.page_count:
+            return None
+        pixmap = pdf[0].get_pixmap()
+        image = Image.frombytes('RGB', (pixmap.width, pixmap.height),
+                                pixmap.samples)
+    image.thumbnail(THUMBNAIL_SIZE)
+    return image
+
+
+def render_thumbnail(document):
+    """ JPEG bytes of the preview of a document, None if unsupported. """
+    extension = os.path.splitext(document.file.name)[1].lower()
+    with document.file.open('rb') as source:
+        if extension in IMAGE_EXTENSIONS:
+            image = _render_image(source)
+        elif extension == '.pdf':
+            image = _render_pdf(source)
+        else:
+            return None
+    if image is None:
+        return None
+    output = BytesIO()
+    image.convert('RGB').save(output, format='JPEG', quality=80)
+    return output.getvalue()
+
+
+def generate_thumbnail(document):
+    thumbnail = AttachmentThumbnail.objects.filter(document=document).first()
+    if thumbnail and thumbnail.source_name == document.file.name:
+        return thumbnail
+
+    content = render_thumbnail(document)
+    if content is None:
+        cache.set(_cache_key(document.pk), NO_THUMBNAIL, NO_THUMBNAIL_TIMEOUT)
+        return None
+    if thumbnail is None:
+        thumbnail = AttachmentThumbnail(document=document)
+    else:
+        thumbnail.file.delete(save=False)
+    thumbnail.source_name = document.file.name
+    name = os.path.splitext(os.path.basename(document.file.name))[0]
+    thumbnail.file.save(f'{name}.jpg', ContentFile(content), save=False)
+    thumbnail.save()
+    cache.set(_cache_key(document.pk), True, CACHE_TIMEOUT)
+    return thumbnail
+
+
+def generate_thumbnails(document_ids):
+    try:
+        for document in get_document_model().objects.filter(pk__in=document_ids):
+            try:
+                generate_thumbnail(document)
+            except Exception:
+                logger.exception('Thumbnail of document %s failed', document.pk)
+    finally:
+        close_old_connections()
+
+
+def schedule_thumbnails(document_ids):
+    """
+        Generate the previews once the current transaction is committed.
+
+        With CHAT_OPINION_THUMBNAILS_TASK the ids are handed to the task
+        queue. Otherwise they go to a thread of the web worker: its queue
+        is lost when the worker restarts and the scans are decoded in the
+        worker process, run ``generate_chat_opinion_thumbnails`` from cron
+        to catch up on dropped jobs. CHAT_OPINION_THUMBNAILS_ASYNC = False
+        generates them inline.
+    """
+    document_ids = list(document_ids)
+    if not document_ids:
+        return
+    if THUMBNAILS_TASK:
+        task = import_string(THUMBNAILS_TASK)
+        transaction.on_commit(lambda: task(document_ids))
+    elif THUMBNAILS_ASYNC:
+        transaction.on_commit(
+            lambda: _executor.submit(generate_thumbnails, document_ids))
+    else:
+        transaction.on_commit(lambda: generate_thumbnails(document_ids))
+
+
+def with_thumbnail(documents):
+    """
+        Primary keys of the documents that have a preview, one cache hit
+        for the batch. Documents without a preview are cached too.
+    """
+    keys = {_cache_key(document.pk): document.pk for document in documents}
+    cached = cache.get_many(list(keys))
+    found = {keys[key] for key, value in cached.items()
+             if value != NO_THUMBNAIL}
+    missing = [pk for key, pk in keys.items() if key not in cached]
+    if missing:
+        generated = set(AttachmentThumbnail.objects.filter(
+            document_id__in=missing).values_list('document_id', flat=True))
+        cache.set_many({_cache_key(pk): True for pk in generated},
+                       CACHE_TIMEOUT)
+        cache.set_many({_cache_key(pk): NO_THUMBNAIL for pk in missing
+                        if pk not in generated}, NO_THUMBNAIL_TIMEOUT)
+        found |= generated
+    return found
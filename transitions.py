@@ -0,0 +1,102 @@
+from django.db import router, transaction
+from django.db.models.signals import post_save
+from django.utils import timezone
+
+from booking.models import booking
+from core.choices import COMPLETE, IN_PROGRESS, NEW
+from .audit import log_bulk_update
+from .signals import chat_opinion_status_changed
+
+
+# target status -> statuses a Chat-opinion case may move from
+ALLOWED_TRANSITIONS = {
+    IN_PROGRESS: (NEW,),
+    COMPLETE: (IN_PROGRESS,),
+}
+
+
+def can_transition(status, target):
+    return status in ALLOWED_TRANSITIONS.get(target, ())
+
+
+def _update_values(target):
+    values = {'status': target}
+    # update() skips the auto_now of TimeStampedModel
+    if any(field.name == 'modified' for field in booking._meta.concrete_fields):
+        values['modified'] = timezone.now()
+    return values
+
+
+def transition(pks, target, user=None):
+    """
+        Move the given bookings to ``target`` with a conditional
+        ``UPDATE ... WHERE status IN (allowed)``, so concurrent accept,
+        complete and cancel requests can not overwrite each other.
+
+        Audit entries and the ``chat_opinion_status_changed`` signal are
+        only produced for the bookings that really changed, which are
+        returned.
+    """
+    sources = ALLOWED_TRANSITIONS[target]
+    pks = list(pks)
+    if not pks:
+        return []
+
+    with transaction.atomic():
+        queryset = booking.objects.filter(pk__in=pks, status__in=sources)
+        if len(pks) == 1 and len(sources) == 1:
+            # the previous status is known, a single statement is enough
+            previous = {pks[0]: sources[0]} if queryset.update(
+                **_update_values(target)) else {}
+        else:
+            previous = dict(queryset.select_for_update().values_list(
+                'pk', 'status'))
+            if previous:
+                booking.objects.filter(pk__in=list(previous)).update(
+                    **_update_values(target))
+
+        if previous:
+            moved = list(previous)
+            log_bulk_update(booking, {
+                pk: {'status': (status, target)}
+                for pk, status in previous.items()
+            }, actor=user)
+            transaction.on_commit(lambda: chat_opinion_status_changed.send(
+                sender=booking, pks=moved, status=target, user=user))
+    return list(previous)
+
+
+def _send_post_save(instance, fields):
+    post_save.send(sender=booking, instance=instance, created=False,
+                   update_fields=frozenset(fields), raw=False,
+                   using=router.db_for_write(booking, instance=instance))
+
+
+def transition_instance(instance, target, user=None):
+    """
+        Single booking flavour of ``transition``. On a real transition the
+        instance is updated in place and ``post_save`` is sent with
+        ``update_fields`` so the booking receivers keep working as they did
+        with ``save()``; nothing is sent when the status did not change.
+    """
+    if not transition([instance.pk], target, user=user):
+        return False
+    values = _update_values(target)
+    for field, value in values.items():
+        setattr(instance, field, value)
+    _send_post_save(instance, values)
+    return True
+
+
+def transition_many(pks, target, user=None):
+    """
+        ``transition`` that also sends ``post_save`` for every booking that
+        moved, exactly like ``transition_instance`` does, so a case accepted
+        in bulk notifies the same receivers as one accepted on its own.
+    """
+    moved = transition(pks, target, user=user)
+    if moved:
+        fields = _update_values(target)
+        for instance in booking.objects.filter(pk__in=moved):
+            _send_post_save(instance, fields)
+    return moved
@@ -0,0 +1,100 @@
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.functions import Greatest
+
+from booking.models import booking
+from .models import ChatOpinionConversation, UnreadMessageCounter
+
+
+def message_recipient(conversation):
+    """ User id of the party a message is addressed to. """
+    row = booking.objects.filter(pk=conversation.booking_id).values_list(
+        'patient__parent_id', 'doctor__user_id').first()
+    if row is None:
+        return None
+    patient_user_id, doctor_user_id = row
+    return patient_user_id if conversation.is_doctor_message else doctor_user_id
+
+
+def increment_unread(user_id, amount=1):
+    counters = UnreadMessageCounter.objects.filter(user_id=user_id)
+    if counters.update(count=F('count') + amount):
+        return
+    try:
+        with transaction.atomic():
+            UnreadMessageCounter.objects.create(user_id=user_id, count=amount)
+    except IntegrityError:
+        # created meanwhile by a concurrent message
+        counters.update(count=F('count') + amount)
+
+
+def decrement_unread(user_id, amount=1):
+    UnreadMessageCounter.objects.filter(user_id=user_id).update(
+        count=Greatest(F('count') - amount, 0))
+
+
+def unread_count(user):
+    return UnreadMessageCounter.objects.filter(user=user).values_list(
+        'count', flat=True).first() or 0
+
+
+def mark_read(queryset, user):
+    """
+        Mark the messages of ``queryset`` sent to ``user`` as read and
+        take them off the user's counter.
+    """
+    read = queryset.filter(is_read=False,
+                           is_doctor_message=not user.is_doctor
+                           ).update(is_read=True)
+    if read:
+        decrement_unread(user.pk, read)
+    return read
+
+
+def mark_existing_read(before, batch_size=1000):
+    """
+        One-off backfill for the messages created before the unread
+        counters existed: they all start as unread, mark those created
+        before ``before`` read, in primary key batches so the table is
+        never locked as a whole. Returns the number of updated messages.
+    """
+    messages = ChatOpinionConversation.objects.filter(
+        is_read=False, created__lt=before).order_by('pk')
+    updated = last_pk = 0
+    while True:
+        pks = list(messages.filter(pk__gt=last_pk).values_list(
+            'pk', flat=True)[:batch_size])
+        if not pks:
+            return updated
+        updated += ChatOpinionConversation.objects.filter(
+            pk__in=pks, is_read=False).update(is_read=True)
+        last_pk = pks[-1]
+
+
+def expected_counts():
+    """ user id -> unread messages, recomputed from the conversations. """
+    unread = ChatOpinionConversation.objects.filter(is_read=False)
+    counts = {}
+    for lookup, is_doctor_message in (('booking__doctor__user_id', False),
+                                      ('booking__patient__parent_id', True)):
+        rows = unread.filter(is_doctor_message=is_doctor_message).values(
+            lookup).annotate(unread=Count('id')).values_list(lookup, 'unread')
+        for user_id, count in rows:
+            if user_id is not None:
+                counts[user_id] = counts.get(user_id, 0) + count
+    return counts
+
+
+def reconcile_counters(dry_run=False):
+    """ Repair drifted counters, returns {user id: (stored, expected)}. """
+    expected = expected_counts()
+    stored = dict(UnreadMessageCounter.objects.values_list('user_id', 'count'))
+    drift = {}
+    for user_id in set(expected) | set(stored):
+        if expected.get(user_id, 0) != stored.get(user_id, 0):
+            drift[user_id] = (stored.get(user_id, 0), expected.get(user_id, 0))
+    if not dry_run:
+        for user_id, (_, count) in drift.items():
+            UnreadMessageCounter.objects.update_or_create(
+                user_id=user_id, defaults={'count': count})
+    return drift
@@ -1,3 +1,4 @@
+from django.conf import settings
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import JsonResponse
 from django.template.defaultfilters import striptags
@@ -11,21 +12,27 @@ from wagtail.documents.models import get_document_model
 
 from booking.forms import BasketCreateForm
 from booking.models import booking
-from config.models import Speciality, ComplaintEmailConfig, bookingFee
+from config.models import ComplaintEmailConfig
 from core import choices
 from core.defaults import Chat_OPTION_COMPLAINT
-from core.models import Service
 from doctor.filters import DoctorFilter
 from doctor.models import Doctor
 from django.db.models import Q
 from utils.file_upload import filename_to_title
 from utils.mail import send_mail
 from utils.views import CrispyCreateView
+from .cache import (
+    get_booking_fee, get_chat_opinion_service, get_doctor, get_speciality,
+    get_speciality_facets
+)
 from .forms import CaseDetailPatientDetailForm, ConversationForm, ComplaintForm
 from .models import (
     ChatOpinionQuestion, ChatOptionAnswer,
     ChatOpinionConversation
 )
+from .throttling import ThrottledPostMixin
+from .questionnaires import current_questionnaire_version
+from .thumbnails import schedule_thumbnails
 from .wagtail_hooks import ChatOpinionComplaintAdmin
 
 
@@ -34,26 +41,47 @@ class DoctorListingView(LoginRequiredMixin, AjaxListView):
     page_template = 'Chat_opinion/partial/partial_doctor_list.html'
     model = Doctor
     context_object_name = 'doctors'
+    # read on a replica, see routers.ChatOpinionReplicaMiddleware
+    replica_reads = True
+    page_size = getattr(settings, 'CHAT_OPINION_DOCTORS_PER_PAGE', 12)
+    has_more = None
+    next_cursor = None
 
     def get_queryset(self):
         queryset = super().get_queryset().active()
+        hospitals = Doctor._meta.get_field('hospital').related_model
         queryset = queryset.filter(Chat_opinion=True, is_deleted=False).filter(
-            Q(hospital__is_active=True) | Q(hospital__isnull=True))
+            Q(hospital__isnull=True) |
+            Q(hospital__in=hospitals._default_manager.filter(is_active=True)))
         if self.request.GET.get('speciality', None):
             queryset = DoctorFilter(self.request.GET, queryset).qs
+        if self.request.GET.get('after', '').isdigit():
+            return self.paginate_by_cursor(queryset)
         return queryset
 
+    def paginate_by_cursor(self, queryset):
+        # opt-in keyset pagination: a client sending back the last seen
+        # doctor id as ``after`` gets the next page_size doctors by id
+        # instead of an ever growing ?page= offset. Without ``after`` the
+        # listing keeps its ordering and the el_pagination pages.
+        queryset = queryset.order_by('pk').filter(
+            pk__gt=int(self.request.GET['after']))
+        doctors = list(queryset[:self.page_size + 1])
+        self.has_more = len(doctors) > self.page_size
+        doctors = doctors[:self.page_size]
+        self.next_cursor = doctors[-1].pk if self.has_more else None
+        return doctors
+
     def get_context_data(self, **kwargs):
         ctx = super(DoctorListingView, self).get_context_data(**kwargs)
-        # specialities = Speciality.objects.specialities()
-        specialities = Speciality.objects.specialities().filter(
-            Q(doctor_specialities__isnull=False) & Q(doctor_specialities__is_deleted=False) & Q(
-                doctor_specialities__user__is_active=True) & Q(doctor_specialities__Chat_opinion=True)).distinct().order_by('name')
-        ctx.update({'specialities': specialities, 'step1': True})
+        ctx.update({'specialities': get_speciality_facets(), 'step1': True,
+                    'has_more': self.has_more,
+                    'next_cursor': self.next_cursor})
         return ctx
 
 
-class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
+class CaseDetailView(LoginRequiredMixin, ThrottledPostMixin,
+                     CrispyCreateView):
     model = ChatOpinionQuestion
     template_name = 'Chat_opinion/step_2.html'
     fields = '__all__'
@@ -65,8 +93,8 @@ class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
         context.update({'form': form.get_form_class()})
 
         slug = self.kwargs.get('slug', None)
-        doctor = Doctor.objects.get(user__slug=slug)
-        fees = bookingFee.get_solo().amount
+        doctor = get_doctor(slug, request=self.request)
+        fees = get_booking_fee(request=self.request).amount
         total = doctor.Chat_opinion_fees + fees
         basket_form_init = {
             'hospital': doctor.hospital,
@@ -80,19 +108,15 @@ class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
 
         patient_detail_form_init = dict()
 
-        service_type = Service.objects.filter(slug='Chat-opinion')
-        if service_type.exists():
-            service_type = service_type.first()
+        service_type = get_chat_opinion_service(request=self.request)
+        if service_type:
             basket_form_init.update({'service_type': service_type})
 
-        speciality = self.request.GET.get('speciality', None)
+        speciality = get_speciality(self.request.GET.get('speciality', None),
+                                    request=self.request)
         if speciality:
-            specialities = Speciality.objects.filter(slug=speciality)
-            if specialities.exists():
-                speciality = specialities.first()
-                basket_form_init.update({'speciality': speciality})
-                patient_detail_form_init.update(
-                    {'speciality': speciality.slug})
+            basket_form_init.update({'speciality': speciality})
+            patient_detail_form_init.update({'speciality': speciality.slug})
 
         basket_form = BasketCreateForm(initial=basket_form_init,
                                        prefix='basket')
@@ -109,7 +133,8 @@ class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
         return context
 
     def post(self, request, *args, **kwargs):
-        form = FormBuilder(self.model.objects.all())
+        questions = self.model.objects.all()
+        form = FormBuilder(questions)
         form_class = form.get_form_class()
         form = form_class(request.POST, request.FILES, user=request.user)
         if form.is_valid():
@@ -119,12 +144,17 @@ class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
                 basket = basket_form.save()
                 basket.status = choices.NEW
                 if basket:
+                    # the form builder already evaluated the questions
+                    questions = {question.code: question
+                                 for question in questions}
+                    version = current_questionnaire_version(request=request)
                     for key, value in form.cleaned_data.items():
-                        question_instance = self.model.objects.get(
-                            code=key)
+                        question_instance = questions[key]
                         answer_instance = ChatOptionAnswer.objects.create(
                             question=question_instance,
                             question_label=question_instance.label,
+                            questionnaire_version=version,
+                            question_code=key,
                             answer=value, basket=basket
                         )
                         basket.Chat_opinion_questions.add(
@@ -138,11 +168,9 @@ class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
 
                     speciality = patient_detail_form.cleaned_data.get(
                         'speciality', None)
+                    speciality = get_speciality(speciality, request=request)
                     if speciality:
-                        specialities = Speciality.objects.filter(
-                            slug=speciality)
-                        if specialities.exists():
-                            basket.speciality = specialities.first()
+                        basket.speciality = speciality
                     basket.save()
 
                     if request.FILES:
@@ -201,9 +229,12 @@ class CaseDetailView(LoginRequiredMixin, CrispyCreateView):
                 )
                 file.save()
                 basket.attachments.add(file)
+                files.append(file.pk)
+        schedule_thumbnails(files)
 
 
-class ConversationsReplayView(LoginRequiredMixin, CrispyCreateView):
+class ConversationsReplayView(LoginRequiredMixin, ThrottledPostMixin,
+                              CrispyCreateView):
     form_class = ConversationForm
     model = ChatOpinionConversation
     template_name = 'patient/Chat_opinion_history_detail.html'